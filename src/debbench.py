@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+import os
+from debian.bench import default_cases, run_cases, report, select, compare, \
+	load_report, write_report
+
+
+def print_comparison(rows, regressions, threshold, fp):
+	for key, old, new, ratio in rows:
+		print >>fp, "%-60s %10.6f %10.6f %6.2fx%s" % (
+		  key, old, new, ratio, "  REGRESSION" if ratio > threshold else "")
+	if regressions:
+		print >>fp, "%d of %d benchmarks slower by more than %.2fx" % (
+		  len(regressions), len(rows), threshold)
+
+
+def main(prog, *argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(prog),
+		description="Time the parsers and checks on synthetic inputs.")
+	parser.add_argument("-k", "--select", action="append", default=[], metavar="REGEX",
+		help="only run the benchmarks whose name[params] matches; may be repeated")
+	parser.add_argument("-l", "--list", action="store_true",
+		help="list the benchmarks, without running them")
+	parser.add_argument("-s", "--scale", type=float, default=1.0,
+		help="multiply the size of the synthetic inputs by this (default: %(default)s)")
+	parser.add_argument("-r", "--repeat", type=int, default=5,
+		help="number of timed runs of each benchmark (default: %(default)s)")
+	parser.add_argument("-o", "--output", default="-", metavar="FILE",
+		help="where to write the results, as JSON (default: stdout)")
+	parser.add_argument("-c", "--compare", metavar="BASELINE",
+		help=("compare with the results of an earlier run, and exit with 1 if "
+		      "any benchmark got slower by more than the threshold"))
+	parser.add_argument("-t", "--threshold", type=float, default=1.25,
+		help="ratio of new to old best time that counts as slower (default: %(default)s)")
+	opts = parser.parse_args(argv)
+
+	cases = select(default_cases(opts.scale), opts.select)
+	if opts.list:
+		for case in cases:
+			print case.key
+		return 0
+
+	results = run_cases(cases, opts.repeat, sys.stderr)
+	rep = report(results, scale=opts.scale, repeat=opts.repeat)
+	if opts.output == "-":
+		write_report(rep, sys.stdout)
+	else:
+		with open(opts.output, "w") as fp:
+			write_report(rep, fp)
+
+	if opts.compare:
+		rows, regressions = compare(load_report(opts.compare), rep, opts.threshold)
+		print_comparison(rows, regressions, opts.threshold,
+		  sys.stderr if opts.output == "-" else sys.stdout)
+		return 1 if regressions else 0
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(*sys.argv))
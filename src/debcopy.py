@@ -1,19 +1,231 @@
 #!/usr/bin/python
 
+import argparse
 import sys
 import os
-from debian.copyright import DebianCopyright, DebianCopyrightMeta, get_license_for_file
+import time
+from debian.copyright import DebianCopyright, DebianCopyrightMeta, FilesResolver, FilesCoverage
+from debian.source import iter_source_paths
+from debian.cache import ParseCache
+from debian.parse import profiling
+from debian.batch import find_copyright_files, check_copyrights, write_records
 
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
 
-def main(prog, fn, *args):
-	pp = DebianCopyrightMeta(os.path.join(os.path.dirname(fn), "changelog"))
-	cr = DebianCopyright.load(fn, pp)
+
+def print_source_licenses(resolver, fn):
+	for path, fi_block in resolver.resolve_all(iter_source_paths(fn)):
+		if fi_block is None:
+			print "%s\t-" % path
+		else:
+			spec, text = fi_block.get("license").model()
+			print "%s\t%s" % (path, spec)
+
+
+def print_coverage(resolver, fn):
+	"""Report globs and Files stanzas that do not apply to any path.
+
+	@return: whether everything applies to some path
+	"""
+	if fn.endswith(".dsc") or ".tar." in os.path.basename(fn):
+		paths = iter_source_paths(fn)
+	else:
+		paths = read_list(fn)
+	cov = FilesCoverage.analyze(None, paths, resolver)
+	for si, pattern in cov.unused_globs():
+		print "unused glob in Files stanza %s: %s" % (si, pattern)
+	shadowed = set(cov.shadowed_stanzas())
+	for si in cov.dead_stanzas():
+		print "%s Files stanza %s: %s" % (
+			"shadowed" if si in shadowed else "unused", si, " ".join(cov.stanzas[si].model()))
+	return not cov.dead_stanzas() and not cov.unused_globs()
+
+
+def read_list(fn):
+	fp = sys.stdin if fn == "-" else open(fn)
+	try:
+		return [line.strip() for line in fp if line.strip()]
+	finally:
+		if fp is not sys.stdin: fp.close()
+
+
+def main_batch(opts):
+	inputs = [opts.copyright] if opts.copyright else []
+	inputs += opts.paths
+	for fn in opts.files_from:
+		inputs += read_list(fn)
+	fns = find_copyright_files(inputs, opts.name)
+	records = check_copyrights(fns, opts.jobs, opts.chunksize, make_cache(opts))
+	if opts.output == "-":
+		failed = write_records(records, sys.stdout)
+	else:
+		with open(opts.output, "w") as fp:
+			failed = write_records(records, fp)
+	return 1 if failed else 0
+
+
+def file_stamp(fn):
+	try:
+		st = os.stat(fn)
+	except OSError:
+		return None
+	return st.st_mtime, st.st_size, st.st_ino
+
+
+def wait_for_change(fn, stamp, interval=1.0):
+	"""Wait until a file exists with a stamp other than the given one.
+
+	Uses inotify on the directory of the file if pyinotify is available,
+	so that a change is seen at once, and otherwise polls every interval
+	seconds.
+
+	@return: the new stamp
+	"""
+	notifier = None
+	if pyinotify:
+		wm = pyinotify.WatchManager()
+		notifier = pyinotify.Notifier(wm, pyinotify.ProcessEvent(), timeout=int(interval * 1000))
+		wm.add_watch(os.path.dirname(os.path.abspath(fn)),
+		  pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE)
+	try:
+		while True:
+			new = file_stamp(fn)
+			if new is not None and new != stamp:
+				return new
+			if notifier is None:
+				time.sleep(interval)
+			elif notifier.check_events():
+				notifier.read_events()
+				notifier.process_events()
+	finally:
+		if notifier is not None:
+			notifier.stop()
+
+
+def main_watch(opts):
+	"""Check a copyright file again every time it changes, re-parsing only
+	the stanzas that changed."""
+	fn = opts.copyright
+	clfn = os.path.join(os.path.dirname(fn), "changelog")
+	cr = stamp = None
+	try:
+		while True:
+			stamp = wait_for_change(fn, stamp, opts.interval)
+			pp = DebianCopyrightMeta(clfn)
+			diag = []
+			try:
+				if cr is None:
+					cr = with_stats(opts, DebianCopyright.load, fn, pp, diag)
+				else:
+					cr = with_stats(opts, DebianCopyright.reload, cr, fn, pp, diag)
+			except Exception, e:
+				print "%s: %s: %s" % (fn, type(e).__name__, e)
+				continue
+			for d in diag:
+				print "%s: %s" % (fn, d)
+			print "%s: %s" % (fn, "%d problem(s)" % len(diag) if diag else "OK")
+			sys.stdout.flush()
+	except KeyboardInterrupt:
+		return 0
+
+
+def with_stats(opts, func, *args):
+	"""Call func, and then print where the time went, if --stats was given."""
+	if not opts.stats:
+		return func(*args)
+	with profiling() as stats:
+		try:
+			return func(*args)
+		finally:
+			stats.write(sys.stderr, 1)
+
+
+def make_cache(opts):
+	if not opts.cache:
+		return None
+	return ParseCache(opts.cache, "copyright", opts.cache_size << 20)
+
+
+def main(prog, *argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+	parser.add_argument("copyright", nargs="?",
+		help="debian/copyright file to check; it is re-written to COPYRIGHT.re")
+	parser.add_argument("paths", nargs="*",
+		help="print the Files stanza that applies to each path")
+	parser.add_argument("-s", "--source", action="append", default=[], metavar="ARCHIVE",
+		help=("print the license of every file in a source tarball, or in all the "
+		      "tarballs of a .dsc, without unpacking it; may be repeated"))
+	parser.add_argument("-u", "--unused", action="append", default=[], metavar="PATHS",
+		help=("report Files globs and stanzas that apply to none of the paths listed "
+		      "one per line in PATHS, or - for stdin, or in a source tarball or .dsc"))
+	parser.add_argument("--cache", metavar="DIR",
+		help=("keep parsed copyright files in DIR, and re-use them while the file and "
+		      "its changelog are unchanged; DIR may be shared by concurrent runs"))
+	parser.add_argument("--cache-size", type=int, default=64, metavar="MB",
+		help="bound on the size of the cache (default: %(default)s)")
+	parser.add_argument("-w", "--watch", action="store_true",
+		help=("check the copyright file again every time it is saved, re-parsing only "
+		      "the stanzas that changed, until interrupted"))
+	parser.add_argument("--interval", type=float, default=1.0, metavar="SECONDS",
+		help=("how often to poll the file in --watch mode, when inotify is not "
+		      "available (default: %(default)s)"))
+	parser.add_argument("--stats", action="store_true",
+		help=("print to stderr the time spent in each stage of parsing, checking, "
+		      "resolving globs and writing, by kind of stanza; in --batch mode, "
+		      "only with -j 1, and summed over all the files"))
+	batch = parser.add_argument_group("batch mode")
+	batch.add_argument("-b", "--batch", action="store_true",
+		help=("check many copyright files in parallel, writing one JSON record per "
+		      "package; the positional arguments are then copyright files, or "
+		      "directories to scan for them"))
+	batch.add_argument("-T", "--files-from", action="append", default=[], metavar="LIST",
+		help="also check the copyright files listed one per line in LIST, or - for stdin")
+	batch.add_argument("--name", default="copyright", metavar="GLOB",
+		help="basename of copyright files when scanning directories (default: %(default)s)")
+	batch.add_argument("-j", "--jobs", type=int, default=None,
+		help="number of worker processes (default: one per CPU)")
+	batch.add_argument("--chunksize", type=int, default=16,
+		help="number of files handed to a worker at a time (default: %(default)s)")
+	batch.add_argument("-o", "--output", default="-", metavar="FILE",
+		help="where to write the result records (default: stdout)")
+	opts = parser.parse_args(argv)
+
+	if opts.batch:
+		if opts.stats and opts.jobs != 1:
+			parser.error("--stats only works in --batch mode with -j 1")
+		return with_stats(opts, main_batch, opts)
+	if not opts.copyright:
+		parser.error("no copyright file given")
+	if opts.watch:
+		return main_watch(opts)
+	return with_stats(opts, main_check, opts)
+
+
+def main_check(opts):
+	fn = opts.copyright
+	clfn = os.path.join(os.path.dirname(fn), "changelog")
+	pp = DebianCopyrightMeta(clfn)
+	cache = make_cache(opts)
+	if cache is None:
+		cr = DebianCopyright.load(fn, pp)
+	else:
+		cr = cache.load(DebianCopyright, fn, pp, None, [clfn])
 	cr.save(fn + ".re")
 	#cr.inspect()
 	#print cr.pretty()
-	for arg in args:
+	resolver = FilesResolver(cr)
+	for arg, fi_block in resolver.resolve_all(opts.paths):
 		print arg
-		print get_license_for_file(cr, arg)
+		print fi_block
+	for archive in opts.source:
+		print_source_licenses(resolver, archive)
+	ok = True
+	for fn in opts.unused:
+		ok = print_coverage(resolver, fn) and ok
+	return 0 if ok else 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""
+module debian.batch
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.copyright import DebianCopyright, DebianCopyrightMeta
+from debian.parse import RootParser
+from fnmatch import fnmatch
+from functools import partial
+from multiprocessing import Pool
+from StringIO import StringIO
+import json
+import os
+import sys
+import traceback
+
+
+def find_copyright_files(paths, name="copyright"):
+	"""Generate copyright files from a list of files and directories.
+
+	Directories are scanned recursively for files whose basename matches
+	the glob name; other paths are passed through as they are.
+	"""
+	for path in paths:
+		if not os.path.isdir(path):
+			yield path
+			continue
+		for dn, subdirs, files in os.walk(path):
+			subdirs.sort()
+			for fn in sorted(files):
+				if fnmatch(fn, name):
+					yield os.path.join(dn, fn)
+
+def _format_exc(e):
+	return "".join(traceback.format_exception_only(type(e), e)).strip()
+
+def check_copyright(fn, cache=None):
+	"""Parse and validate one copyright file.
+
+	Never raises; any failure is recorded in the result instead, so that
+	one bad package does not abort a whole batch.
+
+	Parse errors that the parser can recover from are all reported, as
+	"diagnostics", rather than only the first one.
+
+	@param cache: ParseCache to get the parse from, if it is unchanged
+	@return: { "path", "ok", "roundtrip", "warnings", "diagnostics", "error" }
+	"""
+	record = {"path": fn, "ok": False, "roundtrip": None, "warnings": [],
+		"diagnostics": [], "error": None}
+	diag = []
+	stderr = sys.stderr
+	sys.stderr = captured = StringIO()
+	try:
+		clfn = os.path.join(os.path.dirname(fn), "changelog")
+		pp = DebianCopyrightMeta(clfn) if os.path.isfile(clfn) else RootParser
+		if cache is None:
+			cr = DebianCopyright.load(fn, pp, diag)
+		else:
+			cr = cache.load(DebianCopyright, fn, pp, diag, [clfn])
+		with open(fn) as fp:
+			record["roundtrip"] = "".join(cr.iterblock(False)) == fp.read()
+		record["ok"] = not diag
+	except Exception, e:
+		record["error"] = _format_exc(e)
+	finally:
+		sys.stderr = stderr
+	record["diagnostics"] = [
+		{"key": (d.keystr or "").strip(), "line": d.lineno, "error": _format_exc(d.exc)}
+		for d in diag]
+	record["warnings"] = [line[3:] for line in captured.getvalue().splitlines()
+		if line.startswith("W: ")]
+	return record
+
+def check_copyrights(fns, jobs=None, chunksize=16, cache=None):
+	"""Check many copyright files in a pool of worker processes.
+
+	@param jobs: number of workers; None for one per CPU, 1 to run in-process
+	@param chunksize: number of files handed to a worker at a time
+	@param cache: ParseCache shared by the workers, or None
+	@return: generator of check_copyright records, in completion order
+	"""
+	if jobs == 1:
+		for fn in fns:
+			yield check_copyright(fn, cache)
+		return
+	pool = Pool(jobs)
+	try:
+		for record in pool.imap_unordered(
+		  partial(check_copyright, cache=cache), fns, chunksize):
+			yield record
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+def write_records(records, fp):
+	"""Write records as JSON lines, and return the number that failed."""
+	failed = 0
+	for record in records:
+		if not record["ok"]:
+			failed += 1
+		fp.write(json.dumps(record, sort_keys=True))
+		fp.write("\n")
+		fp.flush()
+	return failed
@@ -0,0 +1,336 @@
+"""
+module debian.bench
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.copyright import DebianCopyright, FilesResolver, globDEP5, get_license_for_file
+from debian.debcontrol import ControlParser, ParagraphParser
+from debian.license import LicenseSpec
+from collections import namedtuple
+from StringIO import StringIO
+from timeit import default_timer
+import gc
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+LICENSES = ["GPL-2+", "GPL-3", "LGPL-2.1+", "MIT", "Apache-2.0", "BSD-3", "Expat", "Zlib",
+	"MPL-1.1", "Artistic"]
+
+# separators of compound license expressions, by nesting level, innermost first
+SEPARATORS = [" and ", " or ", ", and ", ", or "]
+
+GLOB_SHAPES = ("plain", "ext", "dir", "question", "star")
+
+EXTS = ["c", "h", "py", "txt", "js", "png"]
+
+
+def license_expr(rng, depth, fanout=2):
+	"""Random license expression, with compound parts nested depth deep."""
+	if depth <= 0:
+		return rng.choice(LICENSES)
+	sep = SEPARATORS[min(depth, len(SEPARATORS)) - 1]
+	return sep.join(license_expr(rng, depth - 1, fanout) for _ in xrange(fanout))
+
+def source_path(rng, dirs=20, files=50):
+	return "src/mod%d/file%d.%s" % (
+	  rng.randrange(dirs), rng.randrange(files), rng.choice(EXTS))
+
+def source_paths(n, seed=0, dirs=20, files=50):
+	rng = random.Random(seed)
+	return [source_path(rng, dirs, files) for _ in xrange(n)]
+
+def dep5_glob(rng, shape, dirs=20, files=50):
+	"""Random DEP-5 glob of the given shape, over the paths of source_path.
+
+	"star" globs are the pathological case for backtracking matchers:
+	many * that each can match almost anything.
+	"""
+	d, f, ext = rng.randrange(dirs), rng.randrange(files), rng.choice(EXTS)
+	if shape == "plain":
+		return "src/mod%d/file%d.%s" % (d, f, ext)
+	elif shape == "ext":
+		return "src/mod%d/*.%s" % (d, ext)
+	elif shape == "dir":
+		return "src/mod%d/*" % d
+	elif shape == "question":
+		return "src/mod?/file%s.%s" % ("?" * len(str(f)), ext)
+	elif shape == "star":
+		return "*" + "*".join("%s" % c for c in "src/mod%d" % d) + "*f*i*l*e*." + ext
+	raise ValueError("unknown glob shape: %s" % shape)
+
+def copyright_text(stanzas, globs=4, shape="ext", depth=1, seed=0):
+	"""Synthetic DEP-5 copyright file.
+
+	@param stanzas: number of Files stanzas
+	@param globs: number of globs per Files stanza
+	@param shape: shape of the globs, one of GLOB_SHAPES
+	@param depth: nesting depth of the license expression of each stanza
+	"""
+	rng = random.Random(seed)
+	out = ["Format: http://www.debian.org/doc/packaging-manuals/copyright-format/1.0/\n",
+		"Upstream-Name: synthetic\n", "\n",
+		"Files: *\n", "Copyright: 2000, Nobody <nobody@example.com>\n", "License: MIT\n", "\n"]
+	for i in xrange(stanzas):
+		out.append("Files: %s\n" % "\n ".join(dep5_glob(rng, shape) for _ in xrange(globs)))
+		out.append("Copyright: %d, Author %d <a%d@example.com>\n" % (1990 + i % 30, i, i))
+		out.append("License: %s\n" % license_expr(rng, depth))
+		if rng.random() < 0.2:
+			out.append("Comment: stanza %d\n .\n notes\n" % i)
+		out.append("\n")
+	for lc in LICENSES:
+		out.append("License: %s\n The full text of %s.\n .\n More text.\n\n" % (lc, lc))
+	out[-1] = out[-1][:-1]
+	return "".join(out)
+
+def packages_text(stanzas, seed=0):
+	"""Synthetic Packages file, as found in a Debian archive."""
+	rng = random.Random(seed)
+	out = []
+	for i in xrange(stanzas):
+		out.append("Package: pkg%d\n" % i)
+		out.append("Version: %d.%d-%d\n" % (rng.randrange(10), rng.randrange(100), rng.randrange(5)))
+		out.append("Architecture: %s\n" % rng.choice(["amd64", "all", "i386"]))
+		out.append("Depends: %s\n" % ", ".join(
+		  "lib%d (>= %d)" % (rng.randrange(stanzas), rng.randrange(9)) for _ in xrange(rng.randrange(1, 8))))
+		out.append("Description: package %d\n" % i)
+		for _ in xrange(rng.randrange(1, 6)):
+			out.append(" some words of description for package %d\n" % i)
+		out.append("\n")
+	return "".join(out)
+
+
+class Case(namedtuple("Case", "name params setup")):
+	"""A benchmark.
+
+	@param name: e.g. "copyright.load"
+	@param params: { name: value } of the synthetic input
+	@param setup: tmpdir -> (func, n); func is what is timed, and does n
+	  operations each time it is called
+	"""
+
+	@property
+	def key(self):
+		return _key(self.name, self.params)
+
+
+class Result(namedtuple("Result", "name params n times")):
+
+	def summary(self):
+		times = sorted(self.times)
+		return {
+			"name": self.name,
+			"params": self.params,
+			"n": self.n,
+			"repeat": len(times),
+			"min": times[0],
+			"median": times[len(times) // 2],
+			"mean": sum(times) / len(times),
+			"per_op": times[0] / self.n if self.n else None,
+		}
+
+
+def _write(tmpdir, name, text):
+	fn = os.path.join(tmpdir, name)
+	with open(fn, "w") as fp:
+		fp.write(text)
+	return fn
+
+def _load_copyright(fn):
+	stderr = sys.stderr
+	sys.stderr = StringIO()  # the checks warn about the synthetic input
+	try:
+		return DebianCopyright.load(fn, diag=[])
+	finally:
+		sys.stderr = stderr
+
+def _copyright_params(stanzas, globs, shape, depth):
+	return {"stanzas": stanzas, "globs": globs, "shape": shape, "depth": depth}
+
+def copyright_cases(stanzas=1000, globs=4, shape="ext", depth=1, paths=2000):
+	params = _copyright_params(stanzas, globs, shape, depth)
+	text = copyright_text(stanzas, globs, shape, depth)
+	path_list = source_paths(paths, seed=1)
+
+	def load(tmpdir):
+		fn = _write(tmpdir, "copyright", text)
+		return (lambda: _load_copyright(fn)), 1
+
+	def save(tmpdir):
+		state = _load_copyright(_write(tmpdir, "copyright", text))
+		out = os.path.join(tmpdir, "copyright.re")
+		return (lambda: state.save(out)), 1
+
+	def render(tmpdir):
+		state = _load_copyright(_write(tmpdir, "copyright", text))
+		return (lambda: "".join(state.iterblock(False))), 1
+
+	def lookup(tmpdir):
+		state = _load_copyright(_write(tmpdir, "copyright", text))
+		return (lambda: [get_license_for_file(state, p) for p in path_list]), len(path_list)
+
+	def resolve(tmpdir):
+		resolver = FilesResolver(_load_copyright(_write(tmpdir, "copyright", text)))
+		return (lambda: [resolver.resolve(p) for p in path_list]), len(path_list)
+
+	lparams = dict(params, paths=paths)
+	return [
+		Case("copyright.load", params, load),
+		Case("copyright.save", params, save),
+		Case("copyright.render", params, render),
+		Case("copyright.get_license_for_file", lparams, lookup),
+		Case("copyright.resolver", lparams, resolve),
+	]
+
+def glob_cases(shape, patterns=50, paths=500):
+	rng = random.Random(2)
+	pattern_list = [dep5_glob(rng, shape) for _ in xrange(patterns)]
+	path_list = source_paths(paths, seed=3)
+
+	def match(tmpdir):
+		pairs = [(g, p) for g in pattern_list for p in path_list]
+		return (lambda: [globDEP5(g, p) for g, p in pairs]), len(pairs)
+
+	return [Case("glob.globDEP5", {"shape": shape, "patterns": patterns, "paths": paths}, match)]
+
+def license_cases(depth, exprs=500):
+	rng = random.Random(4)
+	expr_list = [license_expr(rng, depth) for _ in xrange(exprs)]
+	params = {"depth": depth, "exprs": exprs}
+
+	def parse(tmpdir):
+		def run():
+			LicenseSpec.parse_cache.clear()
+			return [LicenseSpec.parse(e) for e in expr_list]
+		return run, len(expr_list)
+
+	def covered_by(tmpdir):
+		specs = [LicenseSpec.parse(e) for e in expr_list]
+		return (lambda: [spec.covered_by(*spec.leaves()) for spec in specs]), len(specs)
+
+	return [
+		Case("license.parse", params, parse),
+		Case("license.covered_by", params, covered_by),
+	]
+
+def packages_cases(stanzas=20000):
+	text = packages_text(stanzas)
+	parser = ControlParser.use(pselect=lambda _: ParagraphParser)
+
+	def load(tmpdir):
+		fn = _write(tmpdir, "Packages", text)
+		return (lambda: parser.load(fn)), 1
+
+	return [Case("packages.load", {"stanzas": stanzas}, load)]
+
+def default_cases(scale=1.0):
+	"""The standard set of benchmarks; scale multiplies the size of the inputs."""
+	s = lambda n: max(1, int(n * scale))
+	cases = []
+	cases += copyright_cases(s(1000), 4, "ext", 1)
+	cases += copyright_cases(s(1000), 4, "star", 1)
+	cases += copyright_cases(s(200), 20, "question", 4)
+	for shape in GLOB_SHAPES:
+		cases += glob_cases(shape, s(50), s(500))
+	for depth in (1, 2, 4):
+		cases += license_cases(depth, s(500))
+	cases += packages_cases(s(20000))
+	return cases
+
+
+def measure(func, repeat=5):
+	"""Time func, repeat times, after one untimed warm-up call, which also
+	fills the caches that are not cleared by func itself."""
+	func()
+	times = []
+	for _ in xrange(repeat):
+		gc.collect()
+		t = default_timer()
+		func()
+		times.append(default_timer() - t)
+	return times
+
+def run_cases(cases, repeat=5, progress=None):
+	"""Run benchmarks, and return their results as a list of dicts.
+
+	@param progress: file to report each result to as it completes, or None
+	"""
+	results = []
+	tmpdir = tempfile.mkdtemp(prefix="debbench.")
+	try:
+		for case in cases:
+			func, n = case.setup(tmpdir)
+			result = Result(case.name, case.params, n, measure(func, repeat)).summary()
+			results.append(result)
+			if progress:
+				print >>progress, "%-60s %10.6f s" % (case.key, result["min"])
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	return results
+
+def revision():
+	"""Return the git revision of this source tree, or None."""
+	try:
+		out = subprocess.check_output(["git", "rev-parse", "HEAD"],
+		  cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w"))
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return out.strip()
+
+def report(results, **meta):
+	"""Wrap results with a description of the machine and revision."""
+	meta.update({
+		"revision": revision(),
+		"python": sys.version.split()[0],
+		"platform": platform.platform(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+	})
+	return {"meta": meta, "results": results}
+
+
+def _key(name, params):
+	return "%s[%s]" % (name, ",".join("%s=%s" % kv for kv in sorted(params.iteritems())))
+
+def result_key(result):
+	return _key(result["name"], result["params"])
+
+def compare(old, new, threshold=1.25):
+	"""Compare two reports by the best time of each benchmark.
+
+	@return: [(key, old_min, new_min, ratio)], and the keys of those whose
+	  ratio is above threshold
+	"""
+	old_min = dict((result_key(r), r["min"]) for r in old["results"])
+	rows, regressions = [], []
+	for r in new["results"]:
+		key = result_key(r)
+		if key not in old_min:
+			continue
+		ratio = r["min"] / old_min[key] if old_min[key] else float("inf")
+		rows.append((key, old_min[key], r["min"], ratio))
+		if ratio > threshold:
+			regressions.append(key)
+	return rows, regressions
+
+def load_report(fn):
+	with open(fn) as fp:
+		return json.load(fp)
+
+def write_report(rep, fp):
+	json.dump(rep, fp, indent=1, sort_keys=True)
+	fp.write("\n")
+
+def select(cases, patterns):
+	"""Keep the cases whose key matches any of the regex patterns."""
+	if not patterns:
+		return cases
+	return [c for c in cases if any(re.search(p, c.key) for p in patterns)]
@@ -0,0 +1,335 @@
+"""
+module debian.cache
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.parse import Diagnostic, MKVCState, RootParser, Source
+from StringIO import StringIO
+import errno
+import exceptions
+import glob
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+import zlib
+
+
+FORMAT = 3
+
+_fingerprint = []
+
+def code_fingerprint():
+	"""Hash of the source of every module of this package.
+
+	This is part of every cache key, so that entries made by a different
+	version of the parsers or their checks are never used.
+	"""
+	if not _fingerprint:
+		h = hashlib.sha1()
+		for fn in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+			try:
+				with open(fn) as fp:
+					h.update(hashlib.sha1(fp.read()).digest())
+			except IOError:
+				pass
+		_fingerprint.append(h.hexdigest())
+	return _fingerprint[0]
+
+
+def freeze(state, source=None, primary=True):
+	"""Convert a parsed MKVCState into plain data, without its parsers.
+
+	@param source: Source that state was parsed from; spans are then stored
+	  as line numbers into it
+	@param primary: whether to store the primary data; the root state takes
+	  it from its parent parser instead
+	"""
+	return (state.keystr, list(state.primary) if primary else None, state.keyidx,
+	  [list(extra) for extra in state.extras],
+	  [_freeze_child(child, source) for child in state.childs],
+	  _line_range(source, state.span))
+
+def _freeze_child(state, source):
+	if state.keystr is None:  # made by MKVCState.raw
+		return state.extras[0], _line_range(source, state.span)
+	return freeze(state, source)
+
+def thaw(data, parser, keyU, source=None, primary=None):
+	"""Rebuild the MKVCState frozen by freeze, given the parser that made it.
+
+	The parser is only used to find the omaker and keyU of each state; no
+	chunk is classified and no check is run.
+	"""
+	keystr, primary0, keyidx, extras, childs, span = data
+	return MKVCState(
+		parser.omaker,
+		keystr, primary0 if primary is None else primary,
+		[_thaw_child(child, parser, source) for child in childs],
+		keyidx, extras,
+		keyU, _span(source, span))
+
+def _thaw_child(data, parser, source):
+	if len(data) == 2:
+		block, span = data
+		return MKVCState.raw(block, _span(source, span))
+	return thaw(data, parser.pselect(parser.keyC(data[0])), parser.keyU, source)
+
+def freeze_diagnostics(diagnostics):
+	"""Convert Diagnostics into plain data, keeping only the message of
+	each exception, the name of its type, and the name of the nearest
+	builtin exception type that it is an instance of."""
+	return [(d.keystr, d.lineno, type(d.exc).__name__, _builtin_base(type(d.exc)).__name__,
+	  _message(d.exc)) for d in diagnostics]
+
+def thaw_diagnostics(data):
+	"""Rebuild the Diagnostics frozen by freeze_diagnostics.
+
+	An exception of a builtin type is rebuilt as that type. Others are
+	rebuilt as a class of the same name that inherits from the same
+	builtin type, so that they are caught by the same except clauses.
+	"""
+	return [Diagnostic(keystr, lineno, _exception(name, base, message))
+		for keystr, lineno, name, base, message in data]
+
+def _message(exc):
+	try:
+		return str(exc)
+	except UnicodeError:
+		return unicode(exc)
+
+def _builtin_base(cls):
+	for base in cls.__mro__:
+		if getattr(exceptions, base.__name__, None) is base:
+			return base
+	return Exception
+
+def _exception(name, base, message):
+	base = getattr(exceptions, base, None)
+	if not isinstance(base, type) or not issubclass(base, BaseException):
+		raise ValueError("not a builtin exception type: %r" % (base,))
+	if name == base.__name__:
+		try:
+			exc = base(message)
+		except Exception:
+			pass  # e.g. UnicodeDecodeError, which needs more arguments
+		else:
+			if _message(exc) == message:
+				return exc
+	return _replayed_type(name, base)(message)
+
+def _replayed_init(self, message):
+	BaseException.__init__(self, message)
+
+def _replayed_str(self):
+	return self.args[0]
+
+_replayed_types = {}  # { (name, base): type }
+
+def _replayed_type(name, base):
+	cls = _replayed_types.get((name, base))
+	if cls is None:
+		cls = _replayed_types[name, base] = type(str(name), (base,), {
+			"__init__": _replayed_init, "__str__": _replayed_str})
+	return cls
+
+
+def _line_range(source, span):
+	if source is None or span is None:
+		return None
+	offsets = source.offsets
+	return _bisect(offsets, span.start), _bisect(offsets, span.end)
+
+def _bisect(a, x):
+	lo, hi = 0, len(a)
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if a[mid] < x: lo = mid + 1
+		else: hi = mid
+	return lo
+
+def _span(source, span):
+	return None if source is None or span is None else source.span(*span)
+
+
+class ParseCache(object):
+	"""Persistent on-disk cache of parsed documents.
+
+	Entries are keyed by the content of the document, the name of the
+	parser, the source of this package, and the content of any files the
+	parse depends on, such as a changelog read by the parent parser. A hit
+	skips the parse entirely, including every check; the diagnostics and
+	the warnings that the checks printed to stderr are stored with the
+	entry and replayed. Entries hold only plain data, read with marshal,
+	so a shared cache cannot make its users run code; the exceptions of
+	replayed diagnostics are rebuilt as per thaw_diagnostics.
+
+	Entries are written to a temporary file and renamed into place, so
+	several processes may share one cache directory. When the directory
+	grows beyond maxsize bytes, the least recently used entries are removed,
+	down to lowater of maxsize. To avoid scanning the directory on every
+	write, its size is estimated from the last scan plus the entries this
+	process has written since; it is scanned again every rescan writes,
+	to count those written by other processes.
+
+	@param directory: where to keep the entries; created if absent
+	@param name: identity of the parser, e.g. "copyright"
+	@param maxsize: bound on the total size of the entries, in bytes
+	@param rescan: number of writes between scans of the directory
+	"""
+
+	suffix = ".mkvc"
+	lowater = 0.9
+
+	def __init__(self, directory, name, maxsize=64 << 20, rescan=256):
+		self.directory = directory
+		self.name = name
+		self.maxsize = maxsize
+		self.rescan = rescan
+		self.hits = self.misses = 0
+		self.size = None  # estimated total size of the entries
+		self.puts = 0
+
+	def key(self, buf, depends=()):
+		h = hashlib.sha1()
+		h.update("%s\0%s\0%s\0%s\0" % (FORMAT, sys.version, self.name, code_fingerprint()))
+		for data in [buf] + [_read(fn) for fn in depends]:
+			h.update("%d\0" % len(data))
+			h.update(data)
+		return h.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key + self.suffix)
+
+	def load(self, parser, fn, parent=RootParser, diag=None, depends=()):
+		"""Load and parse a file like parser.load, or get it from the cache.
+
+		@param depends: other files that the result depends on; a missing
+		  file is treated as empty
+		"""
+		source = Source.open(fn)
+		key = self.key(source.buf, depends)
+		entry = self.get(key)
+		if entry is not None:
+			try:
+				state, diagnostics, warnings = self.restore(parser, parent, source, entry)
+			except Exception:
+				entry = None
+		if entry is None:
+			self.misses += 1
+			state, diagnostics, warnings = self.parse(parser, parent, source)
+			self.put(key, (freeze(state, source, False), diagnostics, warnings))
+		else:
+			self.hits += 1
+		sys.stderr.write(warnings)
+		if diagnostics:
+			if diag is None:
+				raise diagnostics[0].exc
+			diag.extend(diagnostics)
+		return state
+
+	def parse(self, parser, parent, source):
+		diagnostics = []
+		stderr = sys.stderr
+		sys.stderr = captured = StringIO()
+		try:
+			state = parser.parse(source.lines(), parent, diagnostics, source)
+		finally:
+			sys.stderr = stderr
+		return state, diagnostics, captured.getvalue()
+
+	def restore(self, parser, parent, source, entry):
+		data, diagnostics, warnings = entry
+		keystr, primary, auxillary = parent.keyX(source.chunks())
+		return thaw(data, parser, parent.keyU, source, primary), diagnostics, warnings
+
+	def get(self, key):
+		fn = self.path(key)
+		try:
+			with open(fn, "rb") as fp:
+				data, diagnostics, warnings = marshal.loads(zlib.decompress(fp.read()))
+			entry = data, thaw_diagnostics(diagnostics), warnings
+			os.utime(fn, None)
+		except Exception:
+			return None
+		return entry
+
+	def put(self, key, entry):
+		try:
+			data, diagnostics, warnings = entry
+			data = zlib.compress(marshal.dumps(
+			  (data, freeze_diagnostics(diagnostics), warnings)))
+		except ValueError:
+			return  # unmarshallable data, e.g. a primary that is not a list of str
+		try:
+			os.makedirs(self.directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST: raise
+		fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=self.directory)
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				fp.write(data)
+			os.rename(tmp, self.path(key))
+		except:
+			_remove(tmp)
+			raise
+		self.grew(len(data))
+
+	def grew(self, n):
+		"""Count an entry of n bytes just written, and evict entries if the
+		directory has grown beyond maxsize."""
+		self.puts += 1
+		if self.size is None or self.puts % self.rescan == 0:
+			self.size = self.total()
+		else:
+			self.size += n
+		if self.size > self.maxsize:
+			self.evict()
+
+	def total(self):
+		return sum(size for _, size, _ in self.entries())
+
+	def entries(self):
+		"""Return [(atime, size, path)] of the entries, oldest first."""
+		entries = []
+		for fn in os.listdir(self.directory):
+			if not fn.endswith(self.suffix): continue
+			path = os.path.join(self.directory, fn)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue  # removed by another process
+			entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+		return sorted(entries)
+
+	def evict(self):
+		"""Remove the least recently used entries, until the total size of
+		the rest is at most lowater of maxsize."""
+		entries = self.entries()
+		total = sum(size for _, size, _ in entries)
+		for _, size, path in entries:
+			if total <= self.maxsize * self.lowater: break
+			_remove(path)
+			total -= size
+		self.size = total
+
+	def clear(self):
+		for _, _, path in self.entries():
+			_remove(path)
+		self.size = 0
+
+
+def _read(fn):
+	try:
+		with open(fn) as fp:
+			return fp.read()
+	except IOError:
+		return ""
+
+def _remove(fn):
+	try:
+		os.remove(fn)
+	except OSError:
+		pass
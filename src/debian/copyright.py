@@ -7,10 +7,12 @@ module debian.copyright
 from debian.debutil import (v_single, v_list, v_text, v_text_synop, v_words)
 from debian.debcontrol import SimpleControlBlock, ControlParser, \
 	ItemCstr
-from debian.license import LicenseSpec
-from debian.parse import PresetRootParser
-from debian.changelog import Changelog
-from itertools import chain
+from debian.license import LicenseSpec, SimpleSpec
+from debian.parse import PresetRootParser, PROFILE
+from debian.changelog import Changelog, Version, topline
+from collections import namedtuple, OrderedDict
+from itertools import chain, imap
+import re
 import sys
 
 
@@ -22,17 +24,19 @@ def warn(fmtstr, args=(), desc=None):
 
 def lcspec_text_synop(lines):
 	syn, desc = v_text_synop(lines)
-	return LicenseSpec.parse(syn), desc
+	spec = LicenseSpec.parse(syn)
+	if not syn and desc:
+		spec = SimpleSpec.anonymous(desc)
+	return spec, desc
 
 
 EXACT, MATCH_ONE, MATCH_ANY = range(3)
 
-def _match1char(c, pattern_, path):
-	return path and c == path[0] and globDEP5(pattern_, path[1:])
-
 def _poptoken(pattern):
 	c, pattern = pattern[0], pattern[1:]
 	if c == "\\":
+		if not pattern:
+			raise SyntaxError("can only escape [\\*?]: end of pattern")
 		c, pattern = pattern[0], pattern[1:]
 		if c in "\\*?":
 			return (EXACT, c), pattern
@@ -45,91 +49,208 @@ def _poptoken(pattern):
 	else:
 		return (EXACT, c), pattern
 
+def _tokenize(pattern):
+	while pattern:
+		tok, pattern = _poptoken(pattern)
+		yield tok
+
+
+class GlobSegment(namedtuple("GlobSegment", "size literal regex")):
+	"""Fixed-width run of a DEP-5 glob between two '*'.
+
+	@param size: number of path characters matched
+	@param literal: the run as a plain string, if it has no '?'
+	@param regex: compiled regex for the run, if it has any '?'
+	"""
+
+	@classmethod
+	def from_tokens(cls, tokens):
+		if all(t == EXACT for t, c in tokens):
+			return cls(len(tokens), "".join(c for t, c in tokens), None)
+		return cls(len(tokens), None, re.compile("".join(
+		  re.escape(c) if t == EXACT else "."
+		  for t, c in tokens), re.DOTALL))
+
+	def match_at(self, path, i):
+		if self.literal is not None:
+			return path.startswith(self.literal, i)
+		return self.regex.match(path, i) is not None
+
+	def find(self, path, i, end):
+		"""Return the leftmost position >= i at which this segment matches
+		without extending beyond end, or -1."""
+		if self.literal is not None:
+			return path.find(self.literal, i, end)
+		m = self.regex.search(path, i, end)
+		return m.start() if m else -1
+
+
+class DEP5Glob(namedtuple("DEP5Glob", "pattern segments anchored")):
+	"""Compiled DEP-5 glob pattern.
+
+	The pattern is split at each '*' into fixed-width segments. A path
+	matches if the first segment matches at its start, the last segment
+	at its end, and the others in order between them; since every segment
+	has a fixed width, taking the leftmost match of each inner segment is
+	enough, so matching takes linear time without any backtracking.
+
+	@param pattern: source pattern string
+	@param segments: [GlobSegment]
+	@param anchored: True if the pattern has no '*' at all
+	"""
+
+	@classmethod
+	def compile(cls, pattern):
+		segments = [[]]
+		for t, c in _tokenize(pattern):
+			if t == MATCH_ANY:
+				segments.append([])
+			else:
+				segments[-1].append((t, c))
+		return cls(pattern,
+		  tuple(map(GlobSegment.from_tokens, segments)),
+		  len(segments) == 1)
+
+	def match(self, path):
+		segments = self.segments
+		head = segments[0]
+		if self.anchored:
+			return len(path) == head.size and head.match_at(path, 0)
+
+		tail = segments[-1]
+		end = len(path) - tail.size
+		if end < head.size or not head.match_at(path, 0) \
+		  or not tail.match_at(path, end):
+			return False
+		i = head.size
+		for k in xrange(1, len(segments) - 1):
+			seg = segments[k]
+			if not seg.size: continue
+			i = seg.find(path, i, end)
+			if i < 0: return False
+			i += seg.size
+		return True
+
+	def __call__(self, path):
+		return self.match(path)
+
+
+_dep5_globs = {}  # { pattern: DEP5Glob }
+DEP5_GLOBS_MAXSIZE = 4096
+
+def compile_dep5_glob(pattern):
+	"""Return a compiled DEP5Glob for the pattern, cached per pattern.
+
+	Like the cache of the re module, the cache is emptied when it holds
+	DEP5_GLOBS_MAXSIZE patterns, so that a long-running process does not
+	keep every pattern it has seen; this keeps hits as cheap as a dict
+	lookup, unlike an LRUCache.
+
+	@raise SyntaxError: if the pattern contains an invalid escape
+	"""
+	glob = _dep5_globs.get(pattern)
+	if glob is None:
+		if len(_dep5_globs) >= DEP5_GLOBS_MAXSIZE:
+			_dep5_globs.clear()
+		glob = _dep5_globs[pattern] = DEP5Glob.compile(pattern)
+	return glob
+
 def globDEP5(pattern, path):
-	#print repr((pattern, path))
-	if not pattern: return not path
-	(t, c), pattern = _poptoken(pattern)
-
-	if t == EXACT:
-		return _match1char(c, pattern, path)
-	elif t == MATCH_ONE:
-		return path and globDEP5(pattern, path[1:])
-	elif t == MATCH_ANY:
-		'''
-		return any(
-		  globDEP5(pattern, path[i:])
-		  for i in xrange(0, len(path) + 1))
-		'''
-		# optimisation of the above naive algorithm; this
-		# makes e.g. globDEP5("********a", "zzzzzzzzzzzzzzzzzzzzzzzb")
-		# run in a sane amount of time
-		while t == MATCH_ANY:
-			if not pattern: return True
-			(t, c), pattern = _poptoken(pattern)
-			if t == EXACT:
-				cand = filter(lambda x: x[1] == c, enumerate(path))
-				ii = [i for i, _ in cand]
-				return any(
-				  globDEP5(pattern, path[i + 1:])
-				  for i in ii)
-			elif t == MATCH_ONE:
-				if not path: return False
-				path = path[1:]
-	raise AssertionError
+	return compile_dep5_glob(pattern).match(path)
+
+class LicenseUsage(object):
+	"""How one License is referred to in a copyright file.
+
+	@param standalone_text: License blocks for it with a full text
+	@param no_text: Files/Format licenses using it, without a full text
+	@param compound_text: compound Files/Format licenses using it, with a full text
+	@param texts: full texts that apply to it, in any block
+	"""
+	__slots__ = ("standalone_text", "no_text", "compound_text", "texts")
+
+	def __init__(self):
+		self.standalone_text = self.no_text = self.compound_text = self.texts = 0
+
+	def __repr__(self):
+		return "LicenseUsage(%s)" % ", ".join(
+		  "%s=%s" % (k, getattr(self, k)) for k in self.__slots__)
+
+
+class LicenseIndex(namedtuple("LicenseIndex", "usage globs compound_blocks")):
+	"""Summary of the licenses of a copyright file, built in one pass.
+
+	@param usage: { License: LicenseUsage }
+	@param globs: [str] all Files globs, in order
+	@param compound_blocks: [LicenseSpec] compound specs of License blocks
+	"""
+
+	@classmethod
+	def build(cls, state):
+		usage = {}
+		globs = []
+		compound_blocks = []
+
+		def _use(lc):
+			u = usage.get(lc)
+			if u is None:
+				u = usage[lc] = LicenseUsage()
+			return u
+
+		fi_blocks = state.getall("files")
+		for fi_block in fi_blocks:
+			globs.extend(fi_block.model())
+
+		for li_block in filter(None, [state.get("format")]) + fi_blocks:
+			lcinfo = li_block.get("license")
+			if not lcinfo: continue
+			spec, text = lcinfo.model()
+			has_text = not not "".join(text).strip()
+			compound = not spec.is_leaf()
+			for leaf in spec.leaves():
+				u = _use(leaf)
+				if has_text:
+					u.texts += 1
+					if compound: u.compound_text += 1
+				else:
+					u.no_text += 1
+
+		for lc_block in state.getall("license"):
+			spec, text = lc_block.model()
+			has_text = not not "".join(text).strip()
+			if not spec.is_leaf():
+				compound_blocks.append(spec)
+				continue
+			for leaf in spec.leaves():
+				u = _use(leaf)
+				if has_text:
+					u.texts += 1
+					u.standalone_text += 1
+
+		return cls(usage, globs, compound_blocks)
+
+
+def license_index(state):
+	"""Return the LicenseIndex of a copyright state, built once and cached."""
+	return state.memo("license_index", LicenseIndex.build)
 
 def copyright_check_post(state):
-	licenses = {}  # { License : [ ( LicenseSpec, has_full_text, standalone ) ] }
-
-	for li_block in [state.get("format")] + state.getall("files"):
-		lcinfo = li_block.get("license")
-		if not lcinfo: continue
-		spec, text = lcinfo.model()
-		has_text = not not "".join(text).strip()
-		leaves = [spec.base()] if spec.is_leaf() else spec.leaves()
-		for leaf in leaves:
-			refs = licenses.setdefault(leaf, [])
-			refs.append((spec, has_text, False))
-
-	for lc_block in state.getall("license"):
-		spec, text = lc_block.model()
-		has_text = not not "".join(text).strip()
-		if spec.is_leaf():
-			refs = licenses.setdefault(spec.base(), [])
-			refs.append((spec, has_text, True))
-		else:
-			raise SyntaxError("Can only specify non-compound License blocks: %s" % spec)
+	index = license_index(state)
+	usage = index.usage
 
-	def _no_standalone_no_text(ref):
-		spec, has_text, standalone = ref
-		return not standalone and not has_text
-
-	def _standalone_with_text(ref):
-		spec, has_text, standalone = ref
-		return standalone and has_text
-
-	def _compound_no_standalone_with_text(ref):
-		spec, has_text, standalone = ref
-		return not spec.is_leaf() and not standalone and has_text
-
-	def _has_text(ref):
-		spec, has_text, standalone = ref
-		return has_text
+	if index.compound_blocks:
+		raise SyntaxError("Can only specify non-compound License blocks: %s" % index.compound_blocks[0])
 
 	# - error when a {file/format license without full text} does not
 	#   have license blocks for any of its components
 	# - specified by DEP-5
-	error_lc_block = filter(
-		lambda lc: filter(_no_standalone_no_text, licenses[lc])
-			and not filter(_standalone_with_text, licenses[lc]),
-		licenses)
+	error_lc_block = [lc for lc, u in usage.iteritems()
+		if u.no_text and not u.standalone_text]
 	if error_lc_block:
 		raise SyntaxError("License in File/Format block with neither full text nor License block: %s" % error_lc_block)
 
 	# - warn on {compound file/format license with full text}, instead
 	#   recommend full texts be split
-	no_standalone_with_text = filter(
-		lambda lc: not not filter(_compound_no_standalone_with_text, licenses[lc]),
-		licenses)
+	no_standalone_with_text = [lc for lc, u in usage.iteritems() if u.compound_text]
 	if no_standalone_with_text:
 		warn("Full text for compound License in File/Format block: %s", no_standalone_with_text,
 			("This is permitted by DEP-5, but we believe it is clearer to split the full text of "
@@ -137,9 +258,7 @@ def copyright_check_post(state):
 			 "licenses are combined, please use the Comment field for that purpose. "))
 
 	# - warn on multiple full texts for same license
-	multi_text = filter(
-		lambda lc: len(filter(_has_text, licenses[lc])) > 1,
-		licenses)
+	multi_text = [lc for lc, u in usage.iteritems() if u.texts > 1]
 	if multi_text:
 		warn("Licenses with multiple full texts: %s", multi_text,
 			("This is permitted by DEP-5, but we believe it is clearer to refactor these into a "
@@ -148,9 +267,7 @@ def copyright_check_post(state):
 
 	# - warn when non-native package, but no separate debian/* clause
 	meta = state.model()
-	globs = [glob
-		for fi_block in state.getall("files")
-		for glob in fi_block.model()]
+	globs = index.globs
 	if "changelog" in meta and \
 	  meta["changelog"].get_version().debian_revision is not None and \
 	  all(not glob.startswith("debian/") for glob in globs):
@@ -160,18 +277,74 @@ def copyright_check_post(state):
 			 "If they are the case, you may ignore this warning, but it may be clearer to "
 			 "split the glob patterns even so, in case this arrangement ceases in the future. "))
 
-	#for k, vv in licenses.iteritems():
-	#	print k
-	#	for v in vv:
-	#		print "\t", v
+
+class LazyChangelog(object):
+	"""Changelog that only reads the header of its first entry, until
+	something else is needed from it.
+
+	get_version() and get_package() are answered from that header; any
+	other attribute is looked up on the full Changelog, which is parsed on
+	first use.
+	"""
+
+	def __init__(self, fn):
+		self.fn = fn
+		self._full = None
+		self._head = None
+		with open(fn) as fp:
+			for line in fp:
+				m = topline.match(line)
+				if m:
+					self._head = m.group(1), Version(m.group(2))
+					break
+
+	@property
+	def full(self):
+		if self._full is None:
+			with open(self.fn) as fp:
+				self._full = Changelog(fp)
+		return self._full
+
+	def get_version(self):
+		return self._head[1] if self._head else self.full.get_version()
+
+	def get_package(self):
+		return self._head[0] if self._head else self.full.get_package()
+
+	version = property(get_version)
+	package = property(get_package)
+
+	def __getattr__(self, name):
+		return getattr(self.full, name)
+
+	def __len__(self):
+		return len(self.full)
+
+	def __iter__(self):
+		return iter(self.full)
+
+	def __str__(self):
+		return str(self.full)
+
+	def __unicode__(self):
+		return unicode(self.full)
+
+
+def copyright_meta(primary):
+	"""Make the model of a copyright file's root state, from a changelog."""
+	if isinstance(primary, LazyChangelog):
+		return {"changelog": primary}
+	if not primary:
+		return {}
+	return {"changelog": Changelog(primary)}
 
 
 DebianCopyright = ControlParser.cstrKeys(
   ItemCstr.SimpleWithHead("format", [], ["files", "license"])
 ).add_check_post(
 	copyright_check_post
-).use(omaker=lambda chunks:
-	{"changelog": Changelog(chunks)} if chunks else {}
+).use(
+	omaker=copyright_meta
 ).use(pselect={
 	"format" : SimpleControlBlock(v_single, {}, {
 		"upstream-name": v_single,
@@ -194,21 +367,363 @@ DebianCopyright = ControlParser.cstrKeys(
 
 
 def DebianCopyrightMeta(fn):
-	with open(fn) as fp:
-		return PresetRootParser(fp.readlines())
+	return PresetRootParser(LazyChangelog(fn))
 
 
 def get_license_for_file(state, fn):
+	stats = PROFILE[-1] if PROFILE else None
+	if stats is not None:
+		return stats.timed("files", "get_license_for_file", _get_license_for_file, state, fn)
+	return _get_license_for_file(state, fn)
+
+def _get_license_for_file(state, fn):
 	for fi_block in state.getall("files").__reversed__():
 		for glob in fi_block.model().__reversed__():
-			if globDEP5(glob, fn):
+			if compile_dep5_glob(glob).match(fn):
 				return fi_block
 
-def get_full_text_for_license(state, lc):
-	for fi_block in state.getall("files"):
-		lcinfo = fi_block.get("license")
-		spec, text = lcinfo.model()
-		# TODO(infinity0): rethink, either return one or all?
-		# and what about where full text belongs to a compound license?
+class GlobNode(namedtuple("GlobNode", "childs generic exts")):
+	"""Directory trie node of a FilesResolver.
+
+	@param childs: { dirname: GlobNode }
+	@param generic: [(stanza_index, DEP5Glob)] globs with no usable suffix
+	@param exts: { extension: [(stanza_index, DEP5Glob)] }
+	"""
+
+	@classmethod
+	def new(cls):
+		return cls({}, [], {})
+
+	def candidates(self, ext):
+		yield self.generic
+		if ext is not None and ext in self.exts:
+			yield self.exts[ext]
+
+
+def _glob_prefix(glob):
+	prefix = []
+	for t, c in _tokenize(glob.pattern):
+		if t != EXACT: break
+		prefix.append(c)
+	return "".join(prefix)
+
+def _glob_ext(glob):
+	if glob.anchored: return None
+	tail = glob.segments[-1].literal
+	if not tail or "." not in tail: return None
+	return tail.rsplit(".", 1)[1]
+
+def _path_ext(path):
+	i = path.rfind(".")
+	return path[i + 1:] if i >= 0 else None
+
+
+class FilesResolver(object):
+	"""Index of the Files globs of a copyright MKVCState.
+
+	Globs are filed in a trie by the complete directories of their literal
+	prefix, then bucketed by the extension of their literal suffix. Only the
+	globs along the directory path of a file, with either no suffix or a
+	matching one, need to be tried. Globs that are plain strings are looked
+	up directly. The result is the same as get_license_for_file, i.e. the
+	last Files stanza with a matching glob.
+	"""
+
+	def __init__(self, state):
+		stats = PROFILE[-1] if PROFILE else None
+		if stats is not None:
+			start = stats.clock()
+		self.stanzas = state.getall("files")
+		self.globs = []  # [(stanza_index, DEP5Glob)]
+		self.exact = {}  # { path: [(stanza_index, DEP5Glob)] }
+		self.root = GlobNode.new()
+		for si, fi_block in enumerate(self.stanzas):
+			for pattern in OrderedDict.fromkeys(fi_block.model()):
+				self.add(si, compile_dep5_glob(pattern))
+		for bucket in self.exact.itervalues():
+			bucket.sort(reverse=True)
+		for node in self._nodes():
+			node.generic.sort(reverse=True)
+			for bucket in node.exts.itervalues():
+				bucket.sort(reverse=True)
+		if stats is not None:
+			stats.add("files", "index", stats.clock() - start, len(self.globs))
+
+	def add(self, si, glob):
+		self.globs.append((si, glob))
+		if glob.anchored and glob.segments[0].literal is not None:
+			self.exact.setdefault(glob.segments[0].literal, []).append((si, glob))
+			return
+		node = self.root
+		for d in _glob_prefix(glob).split("/")[:-1]:
+			node = node.childs.setdefault(d, GlobNode.new())
+		ext = _glob_ext(glob)
+		if ext is None:
+			node.generic.append((si, glob))
+		else:
+			node.exts.setdefault(ext, []).append((si, glob))
+
+	def _nodes(self):
+		stack = [self.root]
+		while stack:
+			node = stack.pop()
+			yield node
+			stack.extend(node.childs.itervalues())
+
+	def _nodes_for(self, path):
+		node = self.root
+		yield node
+		for d in path.split("/")[:-1]:
+			node = node.childs.get(d)
+			if node is None: return
+			yield node
+
+	def resolve_index(self, path):
+		"""Return the index of the last Files stanza matching path, or -1."""
+		exact = self.exact.get(path)
+		best = exact[0][0] if exact else -1
+		ext = _path_ext(path)
+		for node in self._nodes_for(path):
+			for cand in node.candidates(ext):
+				for si, glob in cand:
+					if si <= best: break
+					if glob.match(path):
+						best = si
+						break
+		return best
+
+	def matches(self, path):
+		"""Generate (stanza_index, DEP5Glob) for every glob matching path."""
+		for m in self.exact.get(path, ()):
+			yield m
+		ext = _path_ext(path)
+		for node in self._nodes_for(path):
+			for cand in node.candidates(ext):
+				for si, glob in cand:
+					if glob.match(path):
+						yield si, glob
+
+	def resolve(self, path):
+		"""Return the last Files stanza matching path, or None."""
+		stats = PROFILE[-1] if PROFILE else None
+		if stats is None:
+			si = self.resolve_index(path)
+		else:
+			si = stats.timed("files", "resolve", self.resolve_index, path)
+		return self.stanzas[si] if si >= 0 else None
+
+	def resolve_all(self, paths):
+		"""Generate (path, stanza) for each path, with None for no match."""
+		for path in paths:
+			yield path, self.resolve(path)
+
+
+class FilesCoverage(namedtuple("FilesCoverage",
+	"stanzas glob_matches coverage unmatched")):
+	"""How the Files stanzas of a copyright file apply to a list of paths.
+
+	@param stanzas: [MKVCState] the Files stanzas
+	@param glob_matches: { (stanza_index, pattern): int } paths matched by
+	  each glob, whether or not a later stanza overrides it
+	@param coverage: [int] paths for which each stanza is the last match,
+	  i.e. the one that applies
+	@param unmatched: [str] paths that no stanza applies to
+	"""
+
+	@classmethod
+	def analyze(cls, state, paths, resolver=None):
+		"""Match every path against every candidate glob, in one pass."""
+		resolver = resolver or FilesResolver(state)
+		glob_matches = dict(((si, glob.pattern), 0) for si, glob in resolver.globs)
+		coverage = [0] * len(resolver.stanzas)
+		unmatched = []
+		for path in paths:
+			best = -1
+			for si, glob in resolver.matches(path):
+				glob_matches[si, glob.pattern] += 1
+				if si > best: best = si
+			if best < 0:
+				unmatched.append(path)
+			else:
+				coverage[best] += 1
+		return cls(resolver.stanzas, glob_matches, coverage, unmatched)
+
+	def unused_globs(self):
+		"""Return [(stanza_index, pattern)] of globs that match no path."""
+		return sorted(k for k, n in self.glob_matches.iteritems() if not n)
+
+	def dead_stanzas(self):
+		"""Return the indexes of stanzas that apply to no path, either
+		because none of their globs match, or because later stanzas
+		override them for every path they match."""
+		return [si for si, n in enumerate(self.coverage) if not n]
+
+	def shadowed_stanzas(self):
+		"""Return the indexes of dead stanzas that do match some path."""
+		return [si for si in self.dead_stanzas()
+			if any(self.glob_matches[k] for k in self.glob_matches if k[0] == si)]
+
+
+def stanza_kind(stanza):
+	"""Return "format", "files" or "license" for a copyright stanza."""
+	return ControlParser.keyC(stanza.keystr) if stanza.keystr is not None else None
+
+def stanza_license(stanza):
+	"""Return the (LicenseSpec, text) of a copyright stanza, or None."""
+	kind = stanza_kind(stanza)
+	if kind == "license":
+		return stanza.model()
+	elif kind in ("format", "files"):
+		lcinfo = stanza.get("license")
+		return lcinfo.model() if lcinfo else None
+	return None
+
+
+class LicenseRefs(object):
+	"""Reverse index from each License to the stanzas that use it.
+
+	A stanza uses every leaf of its license spec; it carries a full text for
+	them if its license has a non-empty text. Entries are kept in document
+	order. An index is updated for a copy of the state, with other stanzas,
+	by updated(); see replace_stanzas.
+	"""
+
+	def __init__(self):
+		self.refs = {}  # { License: OrderedDict({ id(stanza): stanza }) }
+		self.texts = {}  # { License: OrderedDict({ id(stanza): stanza }) }
+
+	@classmethod
+	def build(cls, state):
+		index = cls()
+		for stanza in state.childs:
+			index.add(stanza)
+		return index
+
+	def copy(self):
+		index = LicenseRefs()
+		for idx, copied in ((self.refs, index.refs), (self.texts, index.texts)):
+			for leaf, refs in idx.iteritems():
+				copied[leaf] = OrderedDict(refs)
+		return index
+
+	def updated(self, old, new):
+		"""Return a copy of this index of the stanzas old, updated to index
+		the stanzas new instead. Only the stanzas that are not in both are
+		removed or added; stanza states are values, so the others are
+		unchanged."""
+		index = self.copy()
+		was, now = set(imap(id, old)), set(imap(id, new))
+		for stanza in old:
+			if id(stanza) not in now:
+				index.remove(stanza)
+		touched = set()
+		for stanza in new:
+			if id(stanza) not in was:
+				touched.update(index.add(stanza))
+		kept = [id(stanza) for stanza in new if id(stanza) in was]
+		if kept != [id(stanza) for stanza in old if id(stanza) in now]:
+			touched = None  # some stanzas were moved
+		if touched is None or touched:
+			index._sort(new, touched)
+		return index
+
+	def _sort(self, stanzas, leaves=None):
+		"""Put the entries of the leaves, or of all licenses if None, back
+		into the order of stanzas."""
+		pos = {}
+		for i, stanza in enumerate(stanzas):
+			pos.setdefault(id(stanza), i)
+		for idx in (self.refs, self.texts):
+			for leaf in idx.keys() if leaves is None else leaves:
+				if leaf in idx:
+					idx[leaf] = OrderedDict(sorted(idx[leaf].iteritems(),
+					  key=lambda (k, _): pos[k]))
+
+	def _entries(self, stanza):
+		info = stanza_license(stanza)
+		if info is None:
+			return None, ()
+		spec, text = info
+		return "".join(text).strip(), spec.leaves()
+
+	def add(self, stanza):
+		"""Index a stanza after all others; return the leaves it uses."""
+		has_text, leaves = self._entries(stanza)
+		for leaf in leaves:
+			self.refs.setdefault(leaf, OrderedDict())[id(stanza)] = stanza
+			if has_text:
+				self.texts.setdefault(leaf, OrderedDict())[id(stanza)] = stanza
+		return leaves
 
+	def remove(self, stanza):
+		has_text, leaves = self._entries(stanza)
+		for leaf in leaves:
+			for idx in (self.refs, self.texts):
+				refs = idx.get(leaf)
+				if refs and id(stanza) in refs:
+					del refs[id(stanza)]
+					if not refs: del idx[leaf]
+
+	def licenses(self):
+		return self.refs.keys()
+
+	def stanzas(self, lc):
+		"""All stanzas that use the license."""
+		return self.refs.get(lc.base(), {}).values()
+
+	def files(self, lc):
+		"""Files stanzas that use the license."""
+		return [st for st in self.stanzas(lc) if stanza_kind(st) == "files"]
+
+	def full_texts(self, lc):
+		"""Stanzas that carry a full text for the license."""
+		return self.texts.get(lc.base(), {}).values()
+
+	def full_text(self, lc):
+		"""Return the (stanza, text) that best gives the full text of the
+		license, or None.
+
+		A License stanza is preferred, then a Files or Format stanza whose
+		license is just this one; a text given for a compound license is
+		only used as a last resort.
+		"""
+		def rank(stanza):
+			if stanza_kind(stanza) == "license": return 0
+			spec, text = stanza_license(stanza)
+			return 1 if spec.is_leaf() else 2
+		cands = self.full_texts(lc)
+		if not cands:
+			return None
+		best = min(cands, key=rank)
+		return best, stanza_license(best)[1]
+
+
+def license_refs(state):
+	"""Return the LicenseRefs of a copyright state, built once and cached."""
+	return state.memo("license_refs", LicenseRefs.build)
+
+def replace_stanzas(state, childs, keyidx, extras=None):
+	"""Return a copy of a copyright state with other stanzas, like
+	state._replace(childs=childs, keyidx=keyidx, extras=extras).
+
+	Unlike _replace, this carries over the LicenseRefs of state, if it was
+	built, updated for the stanzas that were added or removed, rather than
+	built again from every stanza on the next lookup.
+	"""
+	kwargs = {"childs": childs, "keyidx": keyidx}
+	if extras is not None:
+		kwargs["extras"] = extras
+	new = state._replace(**kwargs)
+	refs = state.memoised("license_refs")
+	if refs is not None:
+		new.memo("license_refs", lambda new: refs.updated(state.childs, new.childs))
+	return new
+
+def get_full_text_for_license(state, lc):
+	"""Return the full text lines for a License or SimpleSpec, or None."""
+	found = license_refs(state).full_text(lc)
+	return found[1] if found else None
 
+def get_files_for_license(state, lc):
+	"""Return the Files stanzas that use a License or SimpleSpec."""
+	return license_refs(state).files(lc)
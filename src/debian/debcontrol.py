@@ -4,10 +4,10 @@ module debian.debcontrol
 @author: Ximin Luo <infinity0@gmx.com> 
 """
 
-from itertools import chain
+from itertools import chain, islice
 from debian.debutil import cont_check, cont_test
-from debian.util import itercut, uninvert_idx, freq
-from debian.parse import MKVCParser, LeafParser
+from debian.util import freq
+from debian.parse import MKVCParser, LeafParser, Tokenizer, TOKENIZERS
 from collections import namedtuple
 
 
@@ -33,6 +33,31 @@ class ItemCstr(namedtuple(
 				  "minimum expected count %s for %s not reached: %s" % (m, k, c))
 		return True
 
+	def compile(self):
+		"""Return a function that does the same check as check, but on a
+		keyidx directly, without building the list of items.
+
+		The count of a key is the length of its index list, and the head is
+		the key whose index list starts with 0.
+		"""
+		head = self.head
+		required = tuple((k, m) for k, m in self.min.iteritems() if m > 0)
+
+		def check_keyidx(keyidx):
+			if head and keyidx:
+				ii = keyidx.get(head)
+				if not ii or ii[0] != 0:
+					first = next((k for k, ii in keyidx.iteritems() if ii[0] == 0), None)
+					raise SyntaxError(
+					  "unexpected head '%s', should be '%s'" % (first, head))
+			for k, m in required:
+				c = len(keyidx.get(k, ()))
+				if c < m:
+					raise SyntaxError(
+					  "minimum expected count %s for %s not reached: %s" % (m, k, c))
+			return True
+		return check_keyidx
+
 	@classmethod
 	def Simple(cls, req, opt):
 		return cls.SimpleWithHead(None, req, opt)
@@ -64,18 +89,28 @@ def blockPcolon(chunk, was_block):
 		cont_check(chunk)
 		return False
 
+# classes of line, for the Tokenizers of the predicates above:
+# 1 empty, 2 whitespace only, 3 comment, 4 has a colon, 5 continuation, 6 other
+LINE_CLASSES = r"(\Z)|(\s+\Z)|(\s*#)|([^:]*:)|(\s)|()"
+
+TOKENIZERS[extraPparagraph, blockPnever] = Tokenizer.new(LINE_CLASSES, "[456][^12]*")
+TOKENIZERS[extraPcomment, blockPcolon] = Tokenizer.new(LINE_CLASSES, "[^3][^34]*", "[16]")
+
 def keyXcolon(block):
 	s, pri0 = block[0].split(':', 1)
-	pri, aux = itercut(cont_test, block[1:])
-	return s, [pri0] + pri, aux
+	pri = [pri0]
+	for line in block[1:]:
+		if not cont_test(line): break
+		pri.append(line)
+	return s, pri, block[len(pri):]
 
 def keyUcolon(s, pri, aux):
-	return ["%s:%s" % (s, pri[0])] + pri[1:] + aux
+	return chain(["%s:%s" % (s, pri[0])], islice(pri, 1, None), aux)
 
 class _BaseLCParser(MKVCParser):
 	def cstrKeys(self, con):
-		check_pre = lambda keystr, primary, keyidx, extras: \
-			con.check(uninvert_idx(keyidx))
+		check = con.compile()
+		check_pre = lambda keystr, primary, keyidx, extras: check(keyidx)
 		return self.add_check_pre(check_pre)
 
 BaseLCParser = _BaseLCParser(
@@ -84,6 +119,7 @@ BaseLCParser = _BaseLCParser(
 	lambda s: s.strip().lower(),
 	None, None,
 	(), (),
+	None, None,
 )
 
 ColonParser = BaseLCParser.use(
@@ -101,10 +137,29 @@ ControlParser = ColonParser.use(
 	blockP=blockPnever,
 )
 
-def SimpleControlBlock(model, req, opt):
+def SimpleControlBlock(model, req, opt, fields=None):
+	"""Paragraph parser with required and optional fields.
+
+	@param fields: if given, only these fields are parsed and checked;
+	  others are kept unparsed, for round-tripping only
+	"""
 	combo = dict(opt.items() + req.items())
-	return ParagraphParser.use(omaker=model).cstrKeys(
+	if fields is not None:
+		fields = frozenset(fields)
+		req = dict((k, v) for k, v in req.iteritems() if k in fields)
+		opt = dict((k, v) for k, v in opt.iteritems() if k in fields)
+	return ParagraphParser.use(omaker=model, project=fields).cstrKeys(
 	  ItemCstr.Simple(req.keys(), opt.keys())
 	).use(
-	  pselect=lambda k: LeafParser.use(omaker=combo.get(k))
+	  # unknown fields are reported by the check above, but when errors are
+	  # recovered from they are still parsed, and keep their raw primary
+	  pselect=lambda k: LeafParser.use(omaker=combo[k]) if k in combo else LeafParser
 	)
+
+def ProjectedControlParser(fields, model=lambda x: x):
+	"""Control parser that only parses the given fields of each paragraph.
+
+	The first field of each paragraph is its key, and is always parsed.
+	"""
+	return ControlParser.use(
+	  pselect=lambda _: ParagraphParser.use(omaker=model, project=frozenset(fields)))
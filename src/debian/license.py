@@ -5,33 +5,53 @@ module debian.license
 """
 
 from collections import namedtuple
+from debian.util import LRUCache
+from hashlib import sha1
 from itertools import chain, product
 import re
 
 
 class LicenseSpec(object):
 
+	# specs are immutable, so equal strings can share one parsed object
+	parse_cache = LRUCache(4096)
+
+	@staticmethod
+	def normalize(s):
+		return " ".join(s.split())
+
 	@staticmethod
 	def parse(s):
-		"""Parse a LicenseSpec from a string."""
+		"""Parse a LicenseSpec from a string.
+
+		Results are interned in parse_cache, keyed by the string with its
+		whitespace normalized.
+		"""
+		return LicenseSpec.parse_cache.get(LicenseSpec.normalize(s), LicenseSpec._parse)
+
+	@staticmethod
+	def cache_info():
+		return LicenseSpec.parse_cache.info()
 
+	@staticmethod
+	def _parse(s):
 		parts = [s]
 
 		parts = re.split(r",\s*or\b", parts[0])
 		if len(parts) > 1:
-			return OrSpec(map(LicenseSpec.parse, parts))
+			return OrSpec(tuple(map(LicenseSpec.parse, parts)))
 
 		parts = re.split(r",\s*and\b", parts[0])
 		if len(parts) > 1:
-			return AndSpec(map(LicenseSpec.parse, parts))
+			return AndSpec(tuple(map(LicenseSpec.parse, parts)))
 
 		parts = re.split(r"\bor\b", parts[0])
 		if len(parts) > 1:
-			return OrSpec(map(LicenseSpec.parse, parts))
+			return OrSpec(tuple(map(LicenseSpec.parse, parts)))
 
 		parts = re.split(r"\band\b", parts[0])
 		if len(parts) > 1:
-			return AndSpec(map(LicenseSpec.parse, parts))
+			return AndSpec(tuple(map(LicenseSpec.parse, parts)))
 
 		# TODO(infinity0): deal with "with X exception"
 		return SimpleSpec.parse(parts[0])
@@ -95,18 +115,28 @@ class LicenseSpec(object):
 		"""
 		raise NotImplementedError
 
+	def coverage(self, bits, full):
+		"""Return the coverage masks of all valid combos of this spec.
+
+		This is the bitset form of covered_by_specs. Each license is given a
+		bit; a SimpleSpec accounts for the bit of the license it names if it
+		is exact, or the bits of all licenses that it matches if it is a
+		plus-spec, and is invalid if that is none. A combo of specs covers
+		the licenses iff none of its specs is invalid, and their bits
+		together are full. Combos with the same mask are equivalent, so at
+		most 2**len(bits) masks are ever kept, instead of every combo.
+
+		@param bits: { License: int } a distinct bit for each license
+		@param full: the mask of all bits
+		@return: frozenset([ int ])
+		"""
+		raise NotImplementedError
+
 	def covered_by(self, *lcc):
 		"""Check that the licenses cover this LicenseSpec."""
-		for specs in self.combo():
-			try:
-				LicenseSpec.covered_by_specs(specs, lcc, True)
-				return True
-			except ValueError, e:
-				#import traceback
-				#traceback.print_exc()
-				#print "rejected %s: %r" % (specs, e)
-				pass
-		return False
+		bits = dict((lc, 1 << i) for i, lc in enumerate(set(lc.base() for lc in lcc)))
+		full = (1 << len(bits)) - 1
+		return full in self.coverage(bits, full)
 
 
 class License(namedtuple("License", "name version")):
@@ -148,15 +178,41 @@ class SimpleSpec(LicenseSpec, namedtuple(
 	def combo(self):
 		return frozenset([frozenset([self])])
 
+	def coverage(self, bits, full):
+		if self.plus:
+			mask = 0
+			for lc, bit in bits.iteritems():
+				if self.matched_by(lc):
+					mask |= bit
+		else:
+			mask = bits.get(self.base(), 0)
+		return frozenset([mask]) if mask else frozenset()
+
 	def __str__(self):
 		return ("%s%s+" if self.plus else "%s%s") % (
-		  self.name, "-%s" % self.version if self.version else "")
+		  self.name, "-%s" % (self.version,) if self.version else "")
+
+	ANON = "_anon"
+
+	@classmethod
+	def anonymous(cls, text=()):
+		"""Spec for a license that is only given by its text.
+
+		Its name is derived from the text, so that different texts give
+		different licenses, and parsing is deterministic.
+		"""
+		text = "\n".join(text)
+		return cls("%s_%s" % (cls.ANON, sha1(text).hexdigest()[:12]) if text else cls.ANON,
+		  LicenseVersion(), False)
+
+	def is_anonymous(self):
+		return self.name.startswith(self.ANON)
 
 	@classmethod
 	def parse(cls, s):
 		s = s.strip()
 		if not s:
-			return cls("_anon%s" % id(object()), (), False)
+			return cls.anonymous()
 
 		plus = False
 		if s and s[-1] == "+":
@@ -190,6 +246,15 @@ class AndSpec(CompoundSpec, namedtuple("AndSpec", "parts")):
 		  for combos in product(*self.subcombos())
 		  )
 
+	def coverage(self, bits, full):
+		masks = frozenset([0])
+		for part in self.parts:
+			pmasks = part.coverage(bits, full)
+			if not pmasks:
+				return pmasks
+			masks = frozenset(a | b for a in masks for b in pmasks)
+		return masks
+
 	def __str__(self):
 		return "(%s)" % " and ".join(str(part) for part in self.parts)
 
@@ -199,6 +264,13 @@ class OrSpec(CompoundSpec, namedtuple("OrSpec", "parts")):
 	def combo(self):
 		return frozenset(chain(*self.subcombos()))
 
+	def coverage(self, bits, full):
+		masks = set()
+		for part in self.parts:
+			masks.update(part.coverage(bits, full))
+			if full in masks: break
+		return frozenset(masks)
+
 	def __str__(self):
 		return "(%s)" % " or ".join(str(part) for part in self.parts)
 
@@ -4,9 +4,25 @@ module debian.parse
 @author: Ximin Luo <infinity0@gmx.com>
 """
 
+from array import array
 from code import interact
 from collections import namedtuple
-from debian.util import Any, dict_append, roundrobin, uninvert_idx
+from contextlib import contextmanager
+from itertools import chain, imap, izip_longest
+from operator import attrgetter
+from string import maketrans
+from timeit import default_timer
+from debian.util import Any, dict_append
+from threading import Lock
+import hashlib
+import mmap
+import os
+import re
+import sys
+
+
+def keyUpreset(s, pri, aux):
+	return aux
 
 
 class PresetRootParser(namedtuple(
@@ -15,15 +31,279 @@ class PresetRootParser(namedtuple(
 	def keyX(self, block):
 		return (None, self.primary, block)
 
-	def keyU(self, s, pri, aux):
-		return aux
+	keyU = staticmethod(keyUpreset)
 
 
 RootParser = PresetRootParser([])
 
 
+class Span(namedtuple("Span", "buf start end")):
+	"""Byte range of a block in the buffer it was parsed from."""
+
+	def text(self):
+		return self.buf[self.start:self.end]
+
+
+class Source(namedtuple("Source", "buf offsets")):
+	"""Buffer that a document was parsed from.
+
+	@param buf: str, mmap, or any buffer that supports find and slicing
+	@param offsets: array of the byte offset of each line, plus the total size
+	"""
+
+	@classmethod
+	def from_string(cls, buf):
+		offsets = array("L", [0])
+		i = buf.find("\n")
+		while i >= 0:
+			offsets.append(i + 1)
+			i = buf.find("\n", i + 1)
+		if offsets[-1] < len(buf):
+			offsets.append(len(buf))
+		return cls(buf, offsets)
+
+	@classmethod
+	def open(cls, fn, use_mmap=False):
+		"""Read a file into a Source, or map it read-only if use_mmap."""
+		with open(fn) as fp:
+			if use_mmap and os.fstat(fp.fileno()).st_size:
+				return cls.from_string(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+			return cls.from_string(fp.read())
+
+	def chunks(self):
+		"""Return all chunks as a ChunkRange, which does not copy them."""
+		return ChunkRange(self, 0, len(self.offsets) - 1)
+
+	def lines(self):
+		"""Return all chunks as a list of str."""
+		buf, offsets = self.buf, self.offsets
+		return map(buf.__getslice__, offsets[:-1], offsets[1:])
+
+	def chunk(self, i):
+		return self.buf[self.offsets[i]:self.offsets[i + 1]]
+
+	def span(self, i, j):
+		"""Span of the lines i to j."""
+		return Span(self.buf, self.offsets[i], self.offsets[j])
+
+
+class ChunkRange(object):
+	"""Read-only sequence of the chunks i to j of a Source.
+
+	Only the range is stored; each chunk is sliced out of the source buffer
+	when it is accessed, and slicing a ChunkRange gives another ChunkRange.
+	"""
+	__slots__ = ("source", "start", "stop")
+
+	def __init__(self, source, start, stop):
+		self.source = source
+		self.start = start
+		self.stop = stop
+
+	def __len__(self):
+		return self.stop - self.start
+
+	def __getitem__(self, k):
+		n = self.stop - self.start
+		if isinstance(k, slice):
+			i, j, step = k.indices(n)
+			if step != 1:
+				raise ValueError("ChunkRange does not support extended slices")
+			return ChunkRange(self.source, self.start + i, self.start + max(i, j))
+		if k < 0: k += n
+		if not 0 <= k < n:
+			raise IndexError("ChunkRange index out of range")
+		return self.source.chunk(self.start + k)
+
+	def __getslice__(self, i, j):
+		n = self.stop - self.start
+		i = min(max(i, 0), n)
+		return ChunkRange(self.source, self.start + i, self.start + max(i, min(j, n)))
+
+	def __iter__(self):
+		offsets = self.source.offsets
+		return imap(self.source.buf.__getslice__,
+		  offsets[self.start:self.stop], offsets[self.start + 1:self.stop + 1])
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(list(self))
+
+
+_class_digits = maketrans("".join(map(chr, range(10))), "0123456789")
+_lastindex = attrgetter("lastindex")
+
+
+class Tokenizer(namedtuple("Tokenizer", "line block error")):
+	"""Compiled equivalent of an extraP and blockP pair.
+
+	Each chunk is classified by one regex match, and the blocks are then
+	found by matching another regex over the classes of all the chunks,
+	so that no Python code is run per chunk.
+
+	@param line: regex with one group per class of chunk, numbered 1 to 9;
+	  the class of a chunk is the last group that matched
+	@param block: regex over the class digits, that matches each block;
+	  None if every chunk is an extra
+	@param error: regex over the class digits, that matches each chunk
+	  after the first of a block on which blockP raises; None if never
+	"""
+
+	@classmethod
+	def new(cls, line, block, error=None):
+		return cls(re.compile(line),
+		  None if block is None else re.compile(block),
+		  None if error is None else re.compile(error))
+
+	def classify(self, chunks):
+		"""Return the class digit of each chunk, as a str."""
+		return str(bytearray(imap(_lastindex, imap(self.line.match, chunks)))
+		  ).translate(_class_digits)
+
+
+TOKENIZERS = {}  # { (extraP, blockP): Tokenizer }
+
+
+class LineClasses(namedtuple("LineClasses", "line start digits")):
+	"""Class digits of a run of chunks, as classified by the regex line,
+	starting from chunk number start of the document.
+
+	Child blocks are runs of their parent's chunks, so the classes found for
+	a parent are passed down and re-used by children with the same regex.
+	"""
+
+	def get(self, line, lineno, n):
+		"""Return the digits of the n chunks from lineno, or None if unknown."""
+		i = lineno - self.start
+		if line is not self.line or i < 0 or i + n > len(self.digits):
+			return None
+		return self.digits[i:i + n]
+
+
+class Diagnostic(namedtuple("Diagnostic", "keystr lineno exc")):
+	"""Error recorded while parsing, instead of raising it.
+
+	@param keystr: key-string of the state being parsed
+	@param lineno: 1-based number of the chunk where the error occurred
+	@param exc: the exception
+	"""
+
+	def __str__(self):
+		return "line %s: %s: %s: %s" % (
+		  self.lineno, (self.keystr or "").strip() or "-", type(self.exc).__name__, self.exc)
+
+
+class Stats(object):
+	"""Wall time, calls and items per stage of parsing, by kind of block.
+
+	The kind of a block is the path of keys from the root to it, e.g.
+	"files" for a Files stanza and "files/license" for its License field.
+	Times are exclusive: the time a stage spends parsing child blocks is
+	counted against the children instead.
+
+	Collection is enabled by the profiling context; while it is not, the
+	parsers only check whether it is.
+	"""
+
+	STAGES = ["tokenize", "split", "check_pre", "mkchild", "check_post", "write"]
+
+	def __init__(self, clock=default_timer):
+		self.clock = clock
+		self.table = {}  # { (kind, stage): [calls, items, seconds] }
+		self.frames = [["", 0.0]]  # [[kind, nested_seconds]] being parsed
+
+	def add(self, kind, stage, seconds, items=1):
+		row = self.table.get((kind, stage))
+		if row is None:
+			row = self.table[kind, stage] = [0, 0, 0.0]
+		row[0] += 1
+		row[1] += items
+		row[2] += seconds
+
+	def enter(self, key):
+		"""Start a block with the given key, inside the current one."""
+		parent = self.frames[-1][0]
+		kind = "%s/%s" % (parent, key) if parent else "" if key is None else "%s" % (key,)
+		self.frames.append([kind, 0.0])
+		return self.clock()
+
+	def exit(self, start):
+		"""End the current block, which was entered at time start."""
+		self.frames.pop()
+		self.frames[-1][1] += self.clock() - start
+
+	def lap(self, stage, start, items=1):
+		"""Count the time since start against a stage of the current block,
+		less any time spent in child blocks; return the time now."""
+		now = self.clock()
+		frame = self.frames[-1]
+		self.add(frame[0], stage, now - start - frame[1], items)
+		frame[1] = 0.0
+		return now
+
+	def timed(self, kind, stage, func, *args):
+		"""Call func, counting it against a stage of the given kind."""
+		start = self.clock()
+		try:
+			return func(*args)
+		finally:
+			self.add(kind, stage, self.clock() - start)
+
+	def rows(self, depth=None):
+		"""Return [(kind, stage, calls, items, seconds)], by kind and stage.
+
+		@param depth: if not None, count kinds nested deeper than this
+		  against their ancestor at this depth
+		"""
+		table = {}
+		for (kind, stage), row in self.table.iteritems():
+			if depth is not None:
+				kind = "/".join(kind.split("/")[:depth])
+			total = table.setdefault((kind, stage), [0, 0, 0.0])
+			for i, v in enumerate(row):
+				total[i] += v
+		order = dict((s, i) for i, s in enumerate(self.STAGES))
+		return sorted(((k, s) + tuple(row) for (k, s), row in table.iteritems()),
+		  key=lambda r: (r[0], order.get(r[1], len(order)), r[1]))
+
+	def write(self, fp, depth=None):
+		rows = self.rows(depth)
+		total = sum(r[4] for r in rows) or 1.0
+		print >>fp, "%-24s %-22s %8s %8s %10s %6s" % (
+		  "kind", "stage", "calls", "items", "seconds", "%")
+		for kind, stage, calls, items, seconds in rows:
+			print >>fp, "%-24s %-22s %8d %8d %10.6f %6.1f" % (
+			  kind or "-", stage, calls, items, seconds, 100 * seconds / total)
+		print >>fp, "%-24s %-22s %8s %8s %10.6f" % ("total", "", "", "", sum(r[4] for r in rows))
+
+
+PROFILE = []  # [Stats], of which the last is collecting, if any
+
+@contextmanager
+def profiling(stats=None):
+	"""Collect Stats of all parsing done in this context.
+
+	@return: the Stats, a new one if none was given
+	"""
+	stats = Stats() if stats is None else stats
+	PROFILE.append(stats)
+	try:
+		yield stats
+	finally:
+		PROFILE.remove(stats)
+
+
+def stdin_is_tty():
+	return sys.stdin is not None and sys.stdin.isatty()
+
+
 class MKVCParser(namedtuple(
-	"MKVCParser", "omaker pselect extraP blockP keyC keyX keyU check_pre check_post")):
+	"MKVCParser", "omaker pselect extraP blockP keyC keyX keyU check_pre check_post interactive project")):
 	"""Multi-key-value chunk parser.
 
 	block :;
@@ -33,15 +313,30 @@ class MKVCParser(namedtuple(
 	auxillary ::
 		auxillary data of a block (e.g. comments), represented as [chunk]
 
+	If a diag list is given to parse, errors are appended to it as
+	Diagnostic and parsing continues: chunks that cannot be classified
+	stay in the current block, and blocks that cannot be split by keyX
+	are kept as unkeyed raw children, so the document still round-trips.
+	Otherwise errors are raised, after dropping into code.interact() if
+	the parser is interactive.
+
+	If a Tokenizer is registered in TOKENIZERS for the pair of extraP and
+	blockP, parse_parts uses it instead of calling them on every chunk.
+
 	@param omaker: primary -> application-level object
 	@param pselect: key -> MKVCParser
 	@param extraP: chunk, was_block -> bool
 	@param blockP: chunk, was_block -> bool
 	@param keyC: keystr -> key
-	@param keyX: block -> keystr, [chunk], [chunk]
-	@param keyU: keystr, [chunk], [chunk] -> block
+	@param keyX: block -> keystr, [chunk], [chunk]; auxillary must be a tail of block
+	@param keyU: keystr, [chunk], iter(chunk) -> iter(chunk); must not
+	  consume the auxillary chunks before it is iterated itself, and must
+	  yield them unchanged, in order
 	@param check_pre: ( keystr, primary, keyidx, extras -> None )
 	@param check_post: ( MKVCState -> None )
+	@param interactive: bool, or None to be interactive iff stdin is a tty
+	@param project: set of keys, or None; if set, blocks with other keys are
+	  not parsed into children, but kept in the extras as they are
 	"""
 
 	def use(self, *args, **kwargs):
@@ -53,115 +348,653 @@ class MKVCParser(namedtuple(
 	def add_check_post(self, check_post):
 		return self._replace(check_post=self.check_post + (check_post,))
 
-	def mkchild(self, parts):
+	def projected(self, chunk):
+		"""Whether a block starting with this chunk should be parsed."""
+		if self.project is None: return True
+		try:
+			return self.keyC(self.keyX([chunk])[0]) in self.project
+		except Exception:
+			return True  # let split_block report it
+
+	def compiled(self):
+		"""Return the Tokenizer registered for extraP and blockP, or None."""
+		return TOKENIZERS.get((self.extraP, self.blockP))
+
+	def is_interactive(self):
+		return stdin_is_tty() if self.interactive is None else self.interactive
+
+	def recover(self, diag, keystr, lineno, e, local):
+		"""Handle an error; return True to continue, or False to re-raise."""
+		if diag is not None:
+			diag.append(Diagnostic(keystr, lineno, e))
+			return True
+		if self.is_interactive():
+			interact(local=local)
+		return False
+
+	def mkchild(self, parts, diag=None, lineno=0, source=None, span=None, classes=None,
+	  start=None):
 		s, pri, aux = parts
-		return self.pselect(self.keyC(s)).parse_parts(s, pri, aux, self)
+		return self.pselect(self.keyC(s)).parse_parts(
+		  s, pri, aux, self, diag, lineno, source, span, classes, start=start)
+
+	def parse(self, block, parent=RootParser, diag=None, source=None):
+		"""Parse a block of chunks.
 
-	def parse(self, block, parent=RootParser):
+		@param source: Source that block was split from, i.e. its chunks();
+		  states then remember their Span and re-use it when serialized
+		"""
+		if not hasattr(block, "__getitem__"):
+			block = list(block)
 		s, pri, aux = parent.keyX(block)
-		return self.parse_parts(s, pri, aux, parent)
+		lineno = 0 if aux is block else len(block) - len(aux)
+		span = source.span(0, len(block)) if source else None
+		mark = len(diag) if diag is not None else 0
+		result = self.parse_parts(s, pri, aux, parent, diag, lineno, source, span, start=0)
+		if diag is not None and len(diag) > mark:
+			result.blame(diag[mark:], 0)
+		return result
 
-	def parse_parts(self, keystr, primary, auxillary, parent):
-		blocks = [[]]  # [block]
-		extras = [[]]  # [block]
-		was_block = False
-		for chunk in auxillary:
-			if self.extraP(chunk, was_block):
-				if was_block:
-					blocks.append([])
-					was_block = False
-				extras[-1].append(chunk)
-			else:
-				if not was_block:
-					extras.append([])
-					was_block = True
-				elif self.blockP(chunk, was_block):
-					blocks.append([])
-				blocks[-1].append(chunk)
-		if not blocks[-1]: blocks.pop()
+	def reparse(self, prev, block, parent=RootParser, diag=None, source=None):
+		"""Parse a new version of a block that prev was parsed from.
+
+		Only the child blocks whose text changed are parsed and checked
+		again; the others, if pristine in prev, are re-used as they are,
+		along with anything memoised on them, and with their diagnostics
+		moved to their new line numbers and reported in the same order as
+		by a fresh parse. The checks of this parser itself, which
+		depend on every child, are run again, but they can use whatever
+		was memoised on the re-used children.
+
+		Children are matched by MKVCState.digest(), so moving a child
+		block does not make it count as changed.
+		"""
+		if not hasattr(block, "__getitem__"):
+			block = list(block)
+		s, pri, aux = parent.keyX(block)
+		lineno = 0 if aux is block else len(block) - len(aux)
+		span = source.span(0, len(block)) if source else None
+		reuse = {}
+		for child in reversed(prev.childs):
+			if child.pristine:
+				reuse.setdefault(child.digest(), []).append(child)
+		mark = len(diag) if diag is not None else 0
+		result = self.parse_parts(s, pri, aux, parent, diag, lineno, source, span,
+		  None, reuse, 0)
+		if diag is not None and len(diag) > mark:
+			result.blame(diag[mark:], 0)
+		return result
+
+	def reload(self, prev, fn, parent=RootParser, diag=None, use_mmap=False):
+		"""Load a file again, after prev was loaded from an earlier version
+		of it, as per reparse."""
+		source = Source.open(fn, use_mmap)
+		chunks = source.chunks() if use_mmap else source.lines()
+		return self.reparse(prev, chunks, parent, diag, source)
+
+	def parse_parts(self, keystr, primary, auxillary, parent, diag=None, lineno=0,
+	  source=None, span=None, classes=None, reuse=None, start=None):
+		"""Parse the auxillary chunks of a block into its child states.
 
+		@param lineno: index of the first auxillary chunk in the document
+		@param reuse: { digest: [MKVCState] } pristine children of a
+		  previous parse, by MKVCState.digest(); a block with the same
+		  digest is not parsed again, but replaced by the last of these
+		@param start: index of the first chunk of the block in the
+		  document, where errors of check_pre and check_post are reported;
+		  None for lineno
+		"""
+		if start is None:
+			start = lineno
+		if not hasattr(auxillary, "__getitem__"):
+			auxillary = list(auxillary)
+		stats = PROFILE[-1] if PROFILE else None
+		if stats is not None:
+			entered = t = stats.enter(None if keystr is None else parent.keyC(keystr))
 		try:
-			allparts = map(self.keyX, blocks)
-			keyidx = reduce(
-				dict_append,
-				((self.keyC(s), i) for i, (s, pri, aux) in enumerate(allparts)),
-				{})
+			# each block is a contiguous run of chunks, and the extras are the
+			# runs between them, so only the block boundaries are tracked here;
+			# blocks that are not projected are not tracked, so they end up in
+			# the extras
+			tokenizer = self.compiled() if auxillary else None
+			if tokenizer is None:
+				starts, stops = self.find_blocks(keystr, auxillary, diag, lineno)
+			else:
+				starts, stops, classes = self.find_blocks_compiled(
+				  tokenizer, keystr, auxillary, diag, lineno, classes)
+			n = len(auxillary)
+			if stats is not None:
+				t = stats.lap("tokenize", t, n)
+
+			blocks = [auxillary[i:j] for i, j in zip(starts, stops)]
+			extras = [auxillary[i:j] for i, j in zip([0] + stops, starts + [n])]
+			starts = [lineno + i for i in starts]  # [chunk_index] of each block
+
+			allparts = []
+			keyidx = {}
+			reused = {}  # { child_index: MKVCState } from a previous parse
+			replayed = set()  # child_index of reused children that could not be split
+			blamed = {}  # { child_index: [Diagnostic] }
+			for ci, block in enumerate(blocks):
+				old = _pop_reusable(reuse, block) if reuse else None
+				if old is not None:
+					# the key is as split_block gives, even if old is raw because
+					# the block could be split but not parsed; its errors are
+					# already in the diagnostics of old, and are replayed where
+					# a fresh parse would report them: here if it could not be
+					# split, or else when the children are built
+					reused[ci] = old
+					try:
+						dict_append(keyidx, (self.keyC(self.keyX(block)[0]), ci))
+					except Exception:
+						if diag is not None:
+							diag.extend(old.diagnostics(starts[ci]))
+						replayed.add(ci)
+					allparts.append(None)
+					continue
+				mark = len(diag) if diag is not None else 0
+				parts = self.split_block(keystr, block, starts[ci], diag)
+				if parts is not None:
+					dict_append(keyidx, (self.keyC(parts[0]), ci))
+				elif diag is not None and len(diag) > mark:
+					blamed[ci] = diag[mark:]
+				allparts.append(parts)
+			if stats is not None:
+				t = stats.lap("split", t, len(blocks))
 
 			for check_pre in self.check_pre:
-				check_pre(keystr, primary, keyidx, extras)
-		except Exception, e:
-			interact(local=locals())
-			raise
+				try:
+					check_pre(keystr, primary, keyidx, extras)
+				except Exception, e:
+					if not self.recover(diag, keystr, start + 1, e, locals()): raise
+			if stats is not None:
+				t = stats.lap("check_pre", t, len(self.check_pre))
+
+			childs = []
+			for ci, (block, parts) in enumerate(zip(blocks, allparts)):
+				child_span = None
+				if source:
+					child_span = source.span(starts[ci], starts[ci] + len(block))
+				if ci in reused:
+					child = reused[ci]
+					if child_span is not None:
+						child = child.with_span(child_span)
+					if diag is not None and ci not in replayed:
+						diag.extend(child.diagnostics(starts[ci]))
+					childs.append(child)
+					continue
+				mark = len(diag) if diag is not None else 0
+				child = self.build_block(keystr, block, parts, starts[ci], diag,
+				  source, child_span, classes)
+				if diag is not None and len(diag) > mark:
+					blamed.setdefault(ci, []).extend(diag[mark:])
+				childs.append(child)
+			for ci, ds in blamed.iteritems():
+				childs[ci].blame(ds, starts[ci])
 
-		try:
-			childs = map(self.mkchild, allparts)
 			result = MKVCState(
 				self.omaker,
 				keystr, primary,
 				childs, keyidx, extras,
-				parent.keyU)
+				parent.keyU, span)
+			if stats is not None:
+				t = stats.lap("mkchild", t, len(childs))
 
 			for check_post in self.check_post:
-				check_post(result)
+				try:
+					check_post(result)
+				except Exception, e:
+					if not self.recover(diag, keystr, start + 1, e, locals()): raise
+			if stats is not None:
+				stats.lap("check_post", t, len(self.check_post))
+
+			return result
+		finally:
+			if stats is not None:
+				stats.exit(entered)
+
+	def find_blocks(self, keystr, auxillary, diag=None, lineno=0):
+		"""Return the indexes of the first and after the last chunk of each
+		projected block, by calling extraP and blockP on every chunk."""
+		starts, stops = [], []
+		was_block = keep = False
+		for i, chunk in enumerate(auxillary):
+			if self.extraP(chunk, was_block):
+				if was_block:
+					if keep: stops.append(i)
+					was_block = False
+			elif not was_block:
+				keep = self.projected(chunk)
+				if keep: starts.append(i)
+				was_block = True
+			else:
+				try:
+					if self.blockP(chunk, was_block):
+						if keep: stops.append(i)
+						keep = self.projected(chunk)
+						if keep: starts.append(i)
+				except Exception, e:
+					if not self.recover(diag, keystr, lineno + i + 1, e, locals()): raise
+		if was_block and keep:
+			stops.append(len(auxillary))
+		return starts, stops
+
+	def find_blocks_compiled(self, tokenizer, keystr, auxillary, diag=None, lineno=0,
+	  classes=None):
+		"""Same as find_blocks, using a Tokenizer instead of the predicates.
+
+		blockP is only called on the chunks that it would raise on, to get
+		the same error.
+
+		@param classes: LineClasses of the parent, if any
+		@return: starts, stops, and the LineClasses for the children
+		"""
+		starts, stops = [], []
+		if tokenizer.block is None:
+			return starts, stops, classes
+		digits = None if classes is None else classes.get(tokenizer.line, lineno, len(auxillary))
+		if digits is None:
+			digits = tokenizer.classify(auxillary)
+			classes = LineClasses(tokenizer.line, lineno, digits)
+		project = self.project is not None
+		for m in tokenizer.block.finditer(digits):
+			i, j = m.span()
+			if tokenizer.error is not None:
+				for err in tokenizer.error.finditer(digits, i + 1, j):
+					k = err.start()
+					try:
+						self.blockP(auxillary[k], True)
+					except Exception, e:
+						if not self.recover(diag, keystr, lineno + k + 1, e, locals()): raise
+			if project and not self.projected(auxillary[i]):
+				continue
+			starts.append(i)
+			stops.append(j)
+		return starts, stops, classes
+
+	def split_block(self, keystr, block, start, diag=None):
+		"""Split a block with keyX, or return None if that fails and diag is given."""
+		try:
+			return self.keyX(block)
 		except Exception, e:
-			interact(local=locals())
-			raise
+			if not self.recover(diag, keystr, start + 1, e, locals()): raise
+			return None
 
-		return result
+	def build_block(self, keystr, block, parts, start, diag=None, source=None, span=None,
+	  classes=None):
+		"""Build the child state for a block split by split_block, or a raw
+		state if it could not be split or parsed."""
+		if parts is not None:
+			try:
+				return self.mkchild(parts, diag, start + len(block) - len(parts[2]),
+				  source, span, classes, start)
+			except Exception, e:
+				if not self.recover(diag, keystr, start + 1, e, locals()): raise
+		return MKVCState.raw(block, span)
 
-	def load(self, fn, parent=RootParser):
+	def iterparse(self, block, parent=RootParser, diag=None):
+		"""Generate the child states of a block, one as soon as each is complete.
+
+		Chunks are read from the block as they are needed, and only those of
+		the current child are kept, so memory use does not depend on the size
+		of the input. Each child is validated by its own parser as usual; the
+		checks of this parser, which need every child at once, are not run,
+		and extras between children are skipped.
+
+		@param block: iterable of chunks, e.g. a file object
+		"""
+		keystr, primary, auxillary = parent.keyX(block)
+		current, start = [], 0
+		was_block = keep = False
+		for i, chunk in enumerate(auxillary):
+			if self.extraP(chunk, was_block):
+				if was_block and current:
+					yield self.build_block(keystr, current,
+					  self.split_block(keystr, current, start, diag), start, diag)
+					current = []
+				was_block = False
+				continue
+			elif not was_block:
+				start = i
+				keep = self.projected(chunk)
+				was_block = True
+			else:
+				try:
+					if self.blockP(chunk, was_block):
+						if current:
+							yield self.build_block(keystr, current,
+							  self.split_block(keystr, current, start, diag), start, diag)
+						current, start = [], i
+						keep = self.projected(chunk)
+				except Exception, e:
+					if not self.recover(diag, keystr, i + 1, e, locals()): raise
+			if keep:
+				current.append(chunk)
+		if current:
+			yield self.build_block(keystr, current,
+			  self.split_block(keystr, current, start, diag), start, diag)
+
+	def iterload(self, fn, parent=RootParser, diag=None):
+		"""Generate the child states of a file, as per iterparse."""
 		with open(fn) as fp:
-			return self.parse(fp, parent)
+			for state in self.iterparse(fp, parent, diag):
+				yield state
+
+	def load(self, fn, parent=RootParser, diag=None, use_mmap=False):
+		"""Load and parse a file.
+
+		@param use_mmap: map the file instead of reading it; chunks are then
+		  kept as ranges of the mapping, and only copied out when used. This
+		  uses much less memory for large files, at some cost in speed.
+		"""
+		source = Source.open(fn, use_mmap)
+		chunks = source.chunks() if use_mmap else source.lines()
+		return self.parse(chunks, parent, diag, source)
+
+
+class KeyTable(object):
+	"""Interns keys into small ints, so that states can store the keys of
+	their children as an array. Id 0 stands for no key.
+
+	Keys are looked up without locking; new ids are assigned under a lock,
+	so that threads parsing at once never give two keys the same id.
+	"""
+
+	def __init__(self):
+		self.ids = {}
+		self.keys = [None]
+		self.lock = Lock()
+
+	def id(self, key):
+		"""Return the id of key, assigning it a new one if needed."""
+		kid = self.ids.get(key)
+		if kid is None:
+			with self.lock:
+				kid = self.ids.get(key)
+				if kid is None:
+					# publish the id only once keys[kid] is there
+					self.keys.append(key)
+					kid = self.ids[key] = len(self.keys) - 1
+		return kid
+
+	def find(self, key):
+		"""Return the id of key, or None if it was never interned."""
+		return self.ids.get(key)
+
+
+KEYS = KeyTable()
+
+SCAN_KEYIDS = 32  # nodes with more children than this look keys up in keyidx
+
+
+class NodeMeta(namedtuple("NodeMeta", "omaker keyU")):
+	"""Parser metadata of a state, shared by all states made by the same
+	parser for the same parent."""
+
+	interned = {}
+
+	@classmethod
+	def get(cls, omaker, keyU):
+		try:
+			meta = cls.interned.get((omaker, keyU))
+		except TypeError:  # e.g. a method of a parser holding a list
+			return cls(omaker, keyU)
+		if meta is None:
+			meta = cls.interned[omaker, keyU] = cls(omaker, keyU)
+		return meta
 
 
-class MKVCState(namedtuple("MKVCState",
-	"omaker keystr primary childs keyidx extras keyU")):
+def _keyids(keyidx, n):
+	if not keyidx:
+		return None
+	ids = array("I", [0]) * n
+	for k, ii in keyidx.iteritems():
+		kid = KEYS.id(k)
+		for i in ii:
+			ids[i] = kid
+	return ids
+
+def _extras(extras, n):
+	if len(extras) == n + 1 and not any(extras):
+		return None
+	return tuple(map(_frozen, extras))
+
+def _frozen(seq):
+	"""Return seq as a tuple, unless it is already immutable, e.g. a
+	ChunkRange or an application-level primary such as a changelog."""
+	return tuple(seq) if seq.__class__ is list else seq
+
+
+class MKVCState(object):
 	"""Multi-key-value chunk parser result state.
 
+	States are values: primary, childs and extras are stored as tuples, so
+	they cannot be modified in place; to modify a state, build a new one
+	with _replace, and rebuild its parents likewise. The new states do not keep their span,
+	so only they are re-rendered when serialized; every untouched state
+	with a span is copied straight from the source buffer.
+
+	States are kept compact, since a document may have millions of them:
+	omaker and keyU are stored once per parser, in a shared NodeMeta; the
+	keys of the children are stored as an array of ids interned in KEYS,
+	and keyidx is only rebuilt from it when asked for; extras that are all
+	empty, as is usual, are not stored at all.
+
 	@param omaker: primary -> application-level object
 	@param keystr: main key-string for this state
-	@param primary: [chunk] main data for this block
-	@param childs: [MKVCState]
+	@param primary: [chunk] main data for this block; stored as a tuple
+	@param childs: [MKVCState]; stored as a tuple
 	@param keyidx: { key: [child_index] }
-	@param extras: [[chunk]] extra comments not part of child block
-	@param keyU: func: key, [chunk], [chunk] -> [chunk]
+	@param extras: [[chunk]] extra comments not part of child block;
+	  stored as a tuple of tuples
+	@param keyU: func: key, [chunk], iter(chunk) -> iter(chunk)
+	@param span: Span of the source this was parsed from, or None if
+	  this state is new or modified
 	"""
+	__slots__ = ("meta", "keystr", "primary", "childs", "keyids", "_extras", "span", "_memo")
+
+	_fields = ("omaker", "keystr", "primary", "childs", "keyidx", "extras", "keyU", "span")
+
+	def __init__(self, omaker, keystr, primary, childs, keyidx, extras, keyU, span=None):
+		self.meta = NodeMeta.get(omaker, keyU)
+		self.keystr = keystr
+		self.primary = _frozen(primary)
+		self.childs = tuple(childs)
+		self.keyids = _keyids(keyidx, len(childs))
+		self._extras = _extras(extras, len(childs))
+		self.span = span
+		self._memo = None
+
+	@classmethod
+	def raw(cls, block, span=None):
+		"""State for a block that could not be parsed; it has no key and
+		reproduces the block unchanged."""
+		return cls(_identity, None, [], [], {}, [block], keyUpreset, span)
+
+	def _replace(self, **kwargs):
+		kwargs.setdefault("span", None)
+		state = MKVCState.__new__(MKVCState)
+		state.meta, state.keystr, state.primary, state.childs, state.keyids, \
+		  state._extras, state.span, state._memo = \
+		  self.meta, self.keystr, self.primary, self.childs, self.keyids, \
+		  self._extras, kwargs.pop("span"), None
+		if "omaker" in kwargs or "keyU" in kwargs:
+			state.meta = NodeMeta.get(
+			  kwargs.pop("omaker", self.omaker), kwargs.pop("keyU", self.keyU))
+		if "keystr" in kwargs:
+			state.keystr = kwargs.pop("keystr")
+		if "primary" in kwargs:
+			state.primary = _frozen(kwargs.pop("primary"))
+		if "childs" in kwargs:
+			state.childs = tuple(kwargs.pop("childs"))
+		if "keyidx" in kwargs:
+			state.keyids = _keyids(kwargs.pop("keyidx"), len(state.childs))
+		if "extras" in kwargs:
+			state._extras = _extras(kwargs.pop("extras"), len(state.childs))
+		elif state._extras is None and len(state.childs) != len(self.childs):
+			state._extras = self.extras
+		if kwargs:
+			raise ValueError("Got unexpected field names: %r" % kwargs.keys())
+		return state
+
+	omaker = property(lambda self: self.meta.omaker)
+	keyU = property(lambda self: self.meta.keyU)
+
+	@property
+	def extras(self):
+		if self._extras is None:
+			return ((),) * (len(self.childs) + 1)
+		return self._extras
+
+	@property
+	def keyidx(self):
+		return self.memo("keyidx", _make_keyidx)
+
+	@property
+	def pristine(self):
+		"""Whether this state is unmodified since it was parsed from a Source."""
+		return self.span is not None
 
 	@property
 	def keys(self):
-		return uninvert_idx(self.keyidx)
+		if self.keyids is None:
+			return []
+		keys = KEYS.keys
+		kk = [keys[kid] for kid in self.keyids]
+		while kk and kk[-1] is None:
+			kk.pop()
+		return kk
 
 	def model(self):
-		return self.omaker(self.primary)
+		"""Return the application-level object for the primary data.
+
+		It is made by omaker on first use, then cached on this state. Since a
+		state with a different primary is a different state, the cache never
+		goes stale; but callers must not modify the object they get.
+		"""
+		return self.memo("model", lambda self: self.omaker(self.primary))
+
+	def memo(self, name, make):
+		"""Return make(self), computed on first use and then cached on this
+		state under name. Like model(), this is for data derived from the
+		state, which cannot go stale since states are values."""
+		d = self._memo
+		if d is None:
+			d = self._memo = {}
+		if name not in d:
+			d[name] = make(self)
+		return d[name]
+
+	def memoised(self, name, d=None):
+		"""Return what is memoised under name, or d if it was never made."""
+		return self._memo.get(name, d) if self._memo is not None else d
+
+	def with_span(self, span):
+		"""Return this state with another span, e.g. in a new version of its
+		source where its text is unchanged. Unlike _replace, this keeps what
+		is memoised on it, since it is still the same value."""
+		state = MKVCState.__new__(MKVCState)
+		state.meta, state.keystr, state.primary, state.childs, state.keyids, \
+		  state._extras, state.span, state._memo = \
+		  self.meta, self.keystr, self.primary, self.childs, self.keyids, \
+		  self._extras, span, self._memo
+		return state
+
+	def digest(self):
+		"""Return the SHA-1 digest of the text of this block."""
+		return self.memo("digest", lambda self: hashlib.sha1(
+		  self.span.text() if self.span is not None else "".join(self.iterblock())).digest())
+
+	def blame(self, diagnostics, start):
+		"""Remember the diagnostics of parsing this block, which starts at
+		chunk index start."""
+		self.memo("diagnostics", lambda self: [
+		  d._replace(lineno=d.lineno - start) for d in diagnostics])
+
+	def diagnostics(self, start=0):
+		"""Return the diagnostics of parsing this block, if the parse was
+		given a diag list, numbered as if it started at chunk index start."""
+		if self._memo is None or "diagnostics" not in self._memo:
+			return []
+		return [d._replace(lineno=d.lineno + start) for d in self._memo["diagnostics"]]
 
 	def get(self, key, d=None):
-		idx = self.keyidx.get(key, [])
-		return self.childs[idx[-1]] if idx else d
+		ii = self._lookup(key)
+		return self.childs[ii[-1]] if ii else d
 
 	def getall(self, key):
-		return [self.childs[i] for i in self.keyidx.get(key, [])]
+		return [self.childs[i] for i in self._lookup(key)]
+
+	def _lookup(self, key):
+		"""Return the indexes of the children with key. Small nodes scan
+		their keyids, so that keyidx is not built for every leaf; larger
+		ones build keyidx once and then look keys up in it."""
+		ids = self.keyids
+		if ids is None:
+			return ()
+		if len(ids) > SCAN_KEYIDS or self._memo is not None and "keyidx" in self._memo:
+			return self.keyidx.get(key, ())
+		kid = KEYS.find(key)
+		if kid is None:
+			return ()
+		return [i for i, k in enumerate(ids) if k == kid]
+
+	def __repr__(self):
+		return "MKVCState(%s)" % ", ".join(
+		  "%s=%r" % (name, getattr(self, name)) for name in self._fields)
 
 	def block(self):
 		try:
-			return self.keyU(self.keystr, self.primary, self.chunks())
+			return list(self.iterblock(False))
 		except Exception, e:
-			interact(local=locals)
+			if stdin_is_tty(): interact(local=locals())
 			raise
 
 	def chunks(self):
-		return [
-			chunk
-			for chunks in roundrobin(
-				self.extras,
-				(state.block() for state in self.childs))
-			for chunk in chunks
-			]
+		return list(self.iterchunks(False))
+
+	def iterblock(self, spans=True):
+		"""Generate the chunks of this block, depth-first, without building
+		any intermediate list.
+
+		@param spans: copy pristine blocks from their source as one chunk,
+		  instead of re-rendering them chunk by chunk
+		"""
+		return walk((self,), spans)
+
+	def iterchunks(self, spans=True):
+		"""Generate the chunks of the extras and child blocks, interleaved
+		in the same order as roundrobin(extras, childs)."""
+		return walk(self.contents(), spans)
+
+	def contents(self):
+		"""Return an iterator over the extras and the child states,
+		interleaved by index, without descending into the children. Each
+		extra is a run of chunks; missing extras or children are None."""
+		return chain.from_iterable(izip_longest(self._extras or (), self.childs))
+
+	def iterstates(self):
+		"""Generate this state and all its descendants, depth-first, in
+		document order."""
+		stack = [iter((self,))]
+		while stack:
+			for state in stack[-1]:
+				yield state
+				if state.childs:
+					stack.append(iter(state.childs))
+					break
+			else:
+				stack.pop()
 
 	def __str__(self):
-		return "".join(self.block())
+		return "".join(self.iterblock())
 
 	def write(self, fp):
-		fp.write(self.__str__())
+		stats = PROFILE[-1] if PROFILE else None
+		if stats is None:
+			fp.writelines(self.iterblock())
+		else:
+			stats.timed(stats.frames[-1][0], "write", fp.writelines, self.iterblock())
 
 	def inspect(self):
 		interact(local=locals())
@@ -177,10 +1010,76 @@ class MKVCState(namedtuple("MKVCState",
 		))
 
 
+def _pop_reusable(reuse, block):
+	old = reuse.get(hashlib.sha1("".join(block)).digest())
+	return old.pop() if old else None
+
+def _identity(x):
+	return x
+
+def _make_keyidx(state):
+	keyidx = {}
+	if state.keyids is not None:
+		keys = KEYS.keys
+		for i, kid in enumerate(state.keyids):
+			if kid:
+				dict_append(keyidx, (keys[kid], i))
+	return keyidx
+
+def walk(items, spans=True):
+	"""Generate the chunks of a sequence of chunks and states, rendering
+	each state as a block, depth-first.
+
+	This keeps an explicit stack of iterators instead of nesting one
+	generator per level of the tree, and hands out whole runs of chunks at
+	a time, so that most chunks are passed on without running any Python
+	code for them. Each state with children is rendered by calling its keyU
+	with a single placeholder for its auxillary chunks; when keyU passes
+	the placeholder through, it is expanded into the state's contents().
+
+	@param items: iterable of chunks and MKVCState
+	@param spans: as per MKVCState.iterblock
+	"""
+	return chain.from_iterable(_walk_runs(items, spans))
+
+def _walk_runs(items, spans):
+	stack = [iter(items)]
+	while stack:
+		for item in stack[-1]:
+			cls = item.__class__
+			if cls is tuple or cls is list or cls is ChunkRange:
+				if item: yield item  # run of extras
+			elif cls is MKVCState or isinstance(item, MKVCState):
+				if spans and item.span is not None:
+					yield (item.span.text(),)
+				elif not item.childs:
+					extras = item._extras
+					yield item.meta.keyU(item.keystr, item.primary,
+					  chain.from_iterable(extras) if extras else ())
+				else:
+					stack.append(iter(item.meta.keyU(item.keystr, item.primary, (item.contents(),))))
+					break
+			elif item is None:
+				continue
+			elif cls is chain:
+				stack.append(item)
+				break
+			else:
+				yield (item,)
+		else:
+			stack.pop()
+
+
+def extraPall(chunk, was_block):
+	return True
+
+TOKENIZERS[extraPall, None] = Tokenizer.new("", None)
+
 LeafParser = MKVCParser(
 	lambda x: x, None,
-	lambda chunk, was_block: True, None,
+	extraPall, None,
 	None,
 	None, None,
 	(), (),
+	None, None,
 )
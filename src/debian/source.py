@@ -0,0 +1,135 @@
+"""
+module debian.source
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.debcontrol import ControlParser, ParagraphParser
+from debian.debutil import v_list
+from itertools import imap
+import os
+import re
+import subprocess
+import tarfile
+
+try:
+	import lzma
+except ImportError:
+	lzma = None
+
+
+DscParser = ControlParser.use(pselect=lambda _: ParagraphParser)
+
+_orig_component = re.compile(r"\.orig-([A-Za-z0-9][-A-Za-z0-9]*)\.tar\.")
+_debian_tarball = re.compile(r"\.debian\.tar\.")
+
+
+def _open_stream(fn):
+	"""Open a tarball for streaming, as (TarFile, cleanup)."""
+	if fn.endswith(".xz"):
+		if lzma:
+			fp = lzma.LZMAFile(fn)
+			return tarfile.open(fileobj=fp, mode="r|"), fp.close
+		proc = subprocess.Popen(["xz", "-dc", fn], stdout=subprocess.PIPE)
+		def cleanup():
+			proc.stdout.close()
+			proc.wait()
+		return tarfile.open(fileobj=proc.stdout, mode="r|"), cleanup
+	tar = tarfile.open(fn, mode="r|*")
+	return tar, lambda: None
+
+def iter_tar_members(fn):
+	"""Generate the non-directory members of a tarball, in archive order.
+
+	The tarball is read as a stream and the members are not kept, so
+	memory use does not depend on the size of the archive.
+	"""
+	tar, cleanup = _open_stream(fn)
+	try:
+		while True:
+			member = tar.next()
+			if member is None: break
+			tar.members = []
+			if not member.isdir():
+				yield member
+	finally:
+		tar.close()
+		cleanup()
+
+def tar_path_prefix(fn):
+	"""Return what replaces the top-level directory of tarball members.
+
+	None means to keep member paths as they are, e.g. for .debian.tar.*
+	whose top-level directory is debian/ already.
+	"""
+	base = os.path.basename(fn)
+	if _debian_tarball.search(base):
+		return None
+	m = _orig_component.search(base)
+	return m.group(1) + "/" if m else ""
+
+def _member_path(member):
+	path = member.name
+	return path[2:] if path.startswith("./") else path
+
+def tar_top_directory(fn):
+	"""Return the top-level directory that every member of a tarball is
+	in, with a trailing "/", or "" if there is none.
+
+	This reads the whole tarball, but keeps nothing but the directory.
+	"""
+	top = None
+	for path in imap(_member_path, iter_tar_members(fn)):
+		if top is None:
+			top = path.split("/", 1)[0] + "/" if "/" in path else ""
+		if not top or not path.startswith(top):
+			return ""
+	return top or ""
+
+def iter_tar_paths(fn, prefix=""):
+	"""Generate the source-relative paths of the files in a tarball.
+
+	@param prefix: replaces the top-level directory of the members, if
+	  they all have the same one; otherwise, or if None, member paths are
+	  kept as they are
+
+	To know whether they all do, the tarball is read twice: once by
+	tar_top_directory, and once to generate the paths, so that no more
+	than one member is held in memory at a time.
+	"""
+	top = "" if prefix is None else tar_top_directory(fn)
+	for path in imap(_member_path, iter_tar_members(fn)):
+		yield prefix + path[len(top):] if top else path
+
+
+def _strip_signature(lines):
+	lines = iter(lines)
+	for line in lines:
+		if not line.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+			yield line
+			continue
+		for line in lines:  # armor headers
+			if not line.strip(): break
+		for line in lines:
+			if line.startswith("-----BEGIN PGP SIGNATURE-----"): break
+			yield line[2:] if line.startswith("- ") else line
+		return
+
+def dsc_tarballs(fn):
+	"""Return the paths of the tarballs listed in a .dsc file."""
+	with open(fn) as fp:
+		state = DscParser.parse(list(_strip_signature(fp)))
+	files = state.childs[0].get("files") if state.childs else None
+	if not files: return []
+	dn = os.path.dirname(fn)
+	return [os.path.join(dn, line.split()[-1])
+		for line in v_list(files.primary) if line
+		if ".tar." in line.split()[-1]]
+
+def iter_source_paths(fn):
+	"""Generate the source-relative paths in a tarball, or in all the
+	tarballs of a .dsc file, without extracting anything."""
+	tarballs = dsc_tarballs(fn) if fn.endswith(".dsc") else [fn]
+	for tarball in tarballs:
+		for path in iter_tar_paths(tarball, tar_path_prefix(tarball)):
+			yield path
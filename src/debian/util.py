@@ -4,7 +4,9 @@ module debian.util
 @author: Ximin Luo <infinity0@gmx.com> 
 """
 
+from collections import namedtuple, OrderedDict
 from itertools import cycle, islice
+from threading import Lock
 
 
 class Any(object): pass
@@ -55,3 +57,47 @@ def itercut(pred, it):
 			break
 	b.extend(it)
 	return a, b
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+class LRUCache(object):
+	"""Bounded thread-safe cache, evicting the least recently used entry."""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.data = OrderedDict()
+		self.lock = Lock()
+		self.hits = self.misses = 0
+
+	def get(self, key, make):
+		"""Return the value for key, calling make(key) to create it if absent.
+
+		make is called without holding the lock; if two threads race to
+		create the same entry, both get the one that was stored first.
+		"""
+		with self.lock:
+			try:
+				value = self.data.pop(key)
+			except KeyError:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self.data[key] = value
+				return value
+		value = make(key)
+		with self.lock:
+			value = self.data.setdefault(key, value)
+			while len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+		return value
+
+	def info(self):
+		with self.lock:
+			return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+	def clear(self):
+		with self.lock:
+			self.data.clear()
+			self.hits = self.misses = 0
@@ -0,0 +1,159 @@
+"""
+Tests for debian.cache; run with PYTHONPATH=src python -m unittest discover tests
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.cache import ParseCache
+from debian.copyright import DebianCopyright, DebianCopyrightMeta
+from StringIO import StringIO
+import marshal
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+
+COPYRIGHT = """\
+Format: http://www.debian.org/doc/packaging-manuals/copyright-format/1.0/
+
+Files: *
+Copyright: 2000, Nobody
+License: MIT
+
+Files: a
+broken line
+License: MIT
+
+License: MIT
+ The text.
+"""
+
+CHANGELOG = """\
+pkg (%s) unstable; urgency=low
+
+  * Initial release.
+
+ -- Nobody <nobody@example.org>  Mon, 12 Sep 2011 20:28:51 +0100
+"""
+
+
+class ParseCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.cachedir = os.path.join(self.tmpdir, "cache")
+		self.cache = ParseCache(self.cachedir, "copyright")
+		self.fn = self.write("copyright", COPYRIGHT)
+		self.clfn = self.write("changelog", CHANGELOG % "1.0-1")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def write(self, name, text):
+		fn = os.path.join(self.tmpdir, name)
+		with open(fn, "w") as fp:
+			fp.write(text)
+		return fn
+
+	def load(self, cache):
+		"""Return (state, diagnostics, warnings) of a load through cache, or
+		of a plain load if cache is None."""
+		diag = []
+		stderr = sys.stderr
+		sys.stderr = captured = StringIO()
+		try:
+			parent = DebianCopyrightMeta(self.clfn)
+			if cache is None:
+				state = DebianCopyright.load(self.fn, parent, diag)
+			else:
+				state = cache.load(DebianCopyright, self.fn, parent, diag, [self.clfn])
+		finally:
+			sys.stderr = stderr
+		return state, diag, captured.getvalue()
+
+	def assertSameLoad(self, (state, diag, warnings), (state0, diag0, warnings0)):
+		pretty = lambda s: re.sub("0x[0-9a-f]+", "", s.pretty())
+		self.assertEqual(pretty(state), pretty(state0))
+		self.assertEqual(str(state), str(state0))
+		self.assertEqual("".join(state.iterblock(False)), "".join(state0.iterblock(False)))
+		self.assertEqual(state.model()["changelog"].version, state0.model()["changelog"].version)
+		self.assertEqual(len(diag), len(diag0))
+		for d, d0 in zip(diag, diag0):
+			self.assertEqual((d.keystr, d.lineno, str(d.exc), type(d.exc).__name__),
+			  (d0.keystr, d0.lineno, str(d0.exc), type(d0.exc).__name__))
+			self.assertIsInstance(d.exc, type(d0.exc))
+		self.assertEqual(warnings, warnings0)
+
+	def entries(self):
+		return [path for _, _, path in self.cache.entries()]
+
+	def test_hit_and_miss(self):
+		base = self.load(None)
+		self.assertTrue(base[1])
+		self.assertIn("W: ", base[2])
+		self.assertSameLoad(self.load(self.cache), base)
+		self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+		self.assertSameLoad(self.load(self.cache), base)
+		self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+	def test_no_diag(self):
+		self.load(self.cache)
+		stdin, stderr = sys.stdin, sys.stderr
+		sys.stdin, sys.stderr = StringIO(), StringIO()  # raise, rather than interact
+		try:
+			for i in range(2):
+				parent = DebianCopyrightMeta(self.clfn)
+				self.assertRaises(ValueError, self.cache.load, DebianCopyright, self.fn, parent,
+				  None, [self.clfn])
+		finally:
+			sys.stdin, sys.stderr = stdin, stderr
+		self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+	def test_changelog_depends(self):
+		key = self.cache.key(COPYRIGHT, [self.clfn])
+		self.load(self.cache)
+		self.write("changelog", CHANGELOG % "1.0")
+		self.assertNotEqual(self.cache.key(COPYRIGHT, [self.clfn]), key)
+		base = self.load(None)
+		self.assertNotIn("W: ", base[2])  # native package
+		self.assertSameLoad(self.load(self.cache), base)
+		self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+		self.assertEqual(len(self.entries()), 2)
+
+	def test_corrupt_entry(self):
+		base = self.load(None)
+		self.load(self.cache)
+		path, = self.entries()
+		for data in ["garbage", zlib.compress("garbage"),
+		  zlib.compress(marshal.dumps(("garbage", [], ""))),
+		  zlib.compress(marshal.dumps(([], [("Files", 1, "Evil", "os", "")], "")))]:
+			with open(path, "wb") as fp:
+				fp.write(data)
+			misses = self.cache.misses
+			self.assertSameLoad(self.load(self.cache), base)
+			self.assertEqual(self.cache.misses, misses + 1)
+			self.assertSameLoad(self.load(self.cache), base)  # rewritten by the miss
+			self.assertEqual(self.cache.misses, misses + 1)
+
+	def test_eviction(self):
+		size = 1000
+		cache = ParseCache(self.cachedir, "copyright", maxsize=10 * size, rescan=4)
+		other = ParseCache(self.cachedir, "copyright", maxsize=1 << 30)
+		for i in range(100):
+			cache.put("k%d" % i, (os.urandom(size), [], ""))
+			if i % 10 == 5:
+				# seen by cache only when it next scans the directory
+				other.put("o%d" % i, (os.urandom(size), [], ""))
+				self.assertLessEqual(cache.total(), cache.maxsize + size)
+			elif cache.puts % cache.rescan == 0 or i % 10 < 5:
+				self.assertLessEqual(cache.total(), cache.maxsize)
+		self.assertTrue(os.path.exists(cache.path("k99")))
+		self.assertFalse(os.path.exists(cache.path("k0")))
+
+
+if __name__ == "__main__":
+	unittest.main()
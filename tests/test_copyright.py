@@ -0,0 +1,161 @@
+"""
+Tests for debian.copyright; run with PYTHONPATH=src python -m unittest discover tests
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.copyright import DebianCopyright, FilesResolver, FilesCoverage, \
+	LicenseRefs, get_license_for_file, license_refs, replace_stanzas
+from debian.debcontrol import ControlParser
+from StringIO import StringIO
+import random
+import sys
+import unittest
+
+
+ESCAPED = """\
+Format: http://www.debian.org/doc/packaging-manuals/copyright-format/1.0/
+
+Files: *
+Copyright: 2000, Nobody
+License: MIT
+
+Files: weird\\*name
+Copyright: 2001, Star
+License: MIT
+
+Files: what\\?
+Copyright: 2002, Question
+License: MIT
+
+Files: back\\\\slash
+ dir/a\\*b*
+Copyright: 2003, Backslash
+License: MIT
+
+License: MIT
+ The text.
+"""
+
+PATHS = ["weird*name", "weirdXname", "what?", "whatX", "back\\slash", "back\\\\slash",
+	"dir/a*b", "dir/a*bc", "dir/aXb", "other"]
+
+
+def parse(text):
+	return DebianCopyright.parse(text.splitlines(True))
+
+
+class FilesResolverTest(unittest.TestCase):
+
+	def test_escaped_globs(self):
+		cr = parse(ESCAPED)
+		resolver = FilesResolver(cr)
+		expected = {
+			"weird*name": "weird\\*name",
+			"what?": "what\\?",
+			"back\\slash": "back\\\\slash",
+			"dir/a*b": "back\\\\slash",
+			"dir/a*bc": "back\\\\slash",
+		}
+		for path in PATHS:
+			stanza = resolver.resolve(path)
+			self.assertIs(stanza, get_license_for_file(cr, path), path)
+			self.assertEqual(stanza.model()[0], expected.get(path, "*"), path)
+
+
+class FilesCoverageTest(unittest.TestCase):
+
+	def test_escaped_globs(self):
+		cov = FilesCoverage.analyze(parse(ESCAPED), ["weird*name", "what?", "back\\slash", "dir/a*b"])
+		self.assertEqual(cov.unused_globs(), [])
+		self.assertEqual(cov.dead_stanzas(), [0])
+		self.assertEqual(cov.coverage, [0, 1, 1, 2])
+
+	def test_unmatched(self):
+		cov = FilesCoverage.analyze(parse(ESCAPED), ["weirdXname", "whatX"])
+		self.assertEqual(cov.unused_globs(),
+		  [(1, "weird\\*name"), (2, "what\\?"), (3, "back\\\\slash"), (3, "dir/a\\*b*")])
+		self.assertEqual(cov.dead_stanzas(), [1, 2, 3])
+		self.assertEqual(cov.coverage[0], 2)
+
+
+LICENSES = """\
+Format: http://www.debian.org/doc/packaging-manuals/copyright-format/1.0/
+
+Files: *
+Copyright: 2000, Nobody
+License: MIT or GPL-2+
+
+Files: a
+Copyright: 2001, Somebody
+License: GPL-2+
+ The GPL text in a Files stanza.
+
+License: GPL-2+
+ The GPL text.
+
+Files: b
+Copyright: 2002, Else
+License: Artistic
+
+License: MIT
+ The MIT text.
+
+License: Artistic
+ The Artistic text.
+
+Files: c
+Copyright: 2003, Other
+License: MIT and Apache-2.0
+ A compound text.
+
+License: MIT
+ Another MIT text.
+"""
+
+
+class LicenseRefsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.stderr = sys.stderr
+		sys.stderr = StringIO()  # the checks warn about the multiple texts
+
+	def tearDown(self):
+		sys.stderr = self.stderr
+
+	def assertSameRefs(self, refs, state):
+		built = LicenseRefs.build(state)
+		self.assertEqual(sorted(refs.licenses()), sorted(built.licenses()))
+		for lc in built.licenses():
+			self.assertEqual(map(id, refs.stanzas(lc)), map(id, built.stanzas(lc)))
+			self.assertEqual(map(id, refs.full_texts(lc)), map(id, built.full_texts(lc)))
+			self.assertEqual(refs.full_text(lc), built.full_text(lc))
+
+	def test_replace_stanzas(self):
+		state = parse(LICENSES)
+		head, stanzas = state.childs[0], list(state.childs[1:])
+		spare = list(parse(LICENSES).childs[1:])
+		rand = random.Random(15)
+		license_refs(state)
+		for _ in range(200):
+			childs = list(state.childs[1:])
+			for _ in range(rand.randint(1, 3)):
+				op = rand.choice(["insert", "remove", "move"])
+				if op == "insert" or not childs:
+					childs.insert(rand.randint(0, len(childs)), rand.choice(stanzas + spare))
+				elif op == "remove":
+					del childs[rand.randrange(len(childs))]
+				else:
+					childs.insert(rand.randint(0, len(childs) - 1), childs.pop(rand.randrange(len(childs))))
+			childs = [head] + childs
+			keyidx = {}
+			for i, child in enumerate(childs):
+				keyidx.setdefault(ControlParser.keyC(child.keystr), []).append(i)
+			new = replace_stanzas(state, childs, keyidx)
+			self.assertIsNotNone(new.memoised("license_refs"))
+			self.assertSameRefs(license_refs(new), new)
+			state = new
+
+
+if __name__ == "__main__":
+	unittest.main()
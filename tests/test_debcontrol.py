@@ -0,0 +1,104 @@
+"""
+Tests for debian.debcontrol; run with PYTHONPATH=src python -m unittest discover tests
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian import parse
+from debian.copyright import DebianCopyright
+from debian.debcontrol import ControlParser, ParagraphParser, ProjectedControlParser
+from debian.parse import Source
+from StringIO import StringIO
+import random
+import sys
+import unittest
+
+
+INPUTS = [
+	"",
+	"\n\n",
+	"A: 1\nB: 2\n\nC: 3\n",
+	# whitespace-only lines, including vertical tab and form feed
+	"A: 1\n  \nB: 2\n\t\n\nC: 3\n",
+	"A: 1\n\x0b\nB: 2\n\x0c\nC: 3\n",
+	"A: 1\n \x0c#\nB: 2\n",
+	"\x0b\n\x0c\nA: 1\n",
+	"A: 1\r\n\r\nB: 2\r\n",
+	# comments with colons
+	"# A: 1\nB: 2\n",
+	"A: 1\n#B: 2\nC: 3\n\n# D: 4\n",
+	"A: 1\n  # not: a comment\n",
+	# continuation lines with colons
+	"A: 1\n a:b\n c: d\nB: 2\n",
+	"A: 1\n .\n x:\nB: 2\n",
+	# stray lines that are not continuations
+	"junk\n",
+	"A: 1\njunk\nB: 2\n",
+	" stray\nA: 1\n",
+	"A: 1\nfoo bar\n\n a:b\n",
+	"A: 1\nB: 2",  # no final newline
+]
+
+LINES = ["Files: *\n", "Copyright: x\n", " cont\n", " .\n", "\n", "  \n", "\t\n", "# c\n",
+	"License: GPL-2+\n", "  # notc\n", "Format: x\n", "Comment: y\n", "junk\n", " a:b\n",
+	"#x:y\n", "\x0b\n", "\x0c\n", "X: 1", "\r\n", " \x0c#\n", "foo bar\n", "A:\n"]
+
+PARSERS = [
+	ControlParser.use(pselect=lambda _: ParagraphParser),
+	ProjectedControlParser(["license", "a"]),
+	DebianCopyright,
+]
+
+
+class TokenizerTest(unittest.TestCase):
+	"""Parse with the registered Tokenizers and with none, where every chunk
+	is classified by extraP and blockP instead, and compare the results."""
+
+	def setUp(self):
+		self.tokenizers = dict(parse.TOKENIZERS)
+		self.stdin = sys.stdin
+		sys.stdin = StringIO()  # raise parse errors, rather than interact
+
+	def tearDown(self):
+		parse.TOKENIZERS.clear()
+		parse.TOKENIZERS.update(self.tokenizers)
+		sys.stdin = self.stdin
+
+	def parse(self, parser, text, diag):
+		source = Source.from_string(text)
+		dg = [] if diag else None
+		stderr = sys.stderr
+		sys.stderr = StringIO()
+		try:
+			state = parser.parse(source.lines(), diag=dg, source=source)
+		except Exception, e:
+			return "error", type(e), str(e)
+		finally:
+			sys.stderr = stderr
+		try:
+			pretty = state.pretty()
+		except Exception, e:  # models are made on first use, and may be invalid
+			pretty = type(e), str(e)
+		return (pretty, "".join(state.iterblock(False)), str(state), state.keys,
+		  state.extras, [(d.keystr, d.lineno, type(d.exc), str(d.exc)) for d in dg or []])
+
+	def check(self, text):
+		for parser in PARSERS:
+			for diag in (True, False):
+				parse.TOKENIZERS.update(self.tokenizers)
+				compiled = self.parse(parser, text, diag)
+				parse.TOKENIZERS.clear()
+				self.assertEqual(compiled, self.parse(parser, text, diag), (text, diag))
+
+	def test_inputs(self):
+		for text in INPUTS:
+			self.check(text)
+
+	def test_random(self):
+		rand = random.Random(19)
+		for _ in range(500):
+			self.check("".join(rand.choice(LINES) for _ in range(rand.randint(0, 14))))
+
+
+if __name__ == "__main__":
+	unittest.main()
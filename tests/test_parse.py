@@ -0,0 +1,137 @@
+"""
+Tests for debian.parse; run with PYTHONPATH=src python -m unittest discover tests
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian.copyright import DebianCopyright
+from debian.debcontrol import ControlParser, ParagraphParser
+from debian.parse import KeyTable, Source
+from StringIO import StringIO
+import random
+import sys
+import threading
+import unittest
+
+
+HEADER = "Format: http://www.debian.org/doc/packaging-manuals/copyright-format/1.0/\n"
+
+STANZAS = [
+	"Files: *\nCopyright: 2000, Nobody\nLicense: MIT\n",
+	"Files: a b\nCopyright: 2001, Somebody\n 2002, Else\nLicense: GPL-2+\n",
+	"Files: debian/*\nCopyright: 2003, Maintainer\nLicense: GPL-2+\n",
+	"# comment: with a colon\nFiles: c\nCopyright: 2004, X\nLicense: MIT\n",
+	"License: MIT\n The text.\n .\n More text.\n",
+	"License: GPL-2+\n The text.\n",
+	"Comment: nothing\n",
+	# malformed
+	"Files: d\nbroken line\nLicense: MIT\n",
+	"Files: e\nLicense: MIT\n",
+	"Files: f\nCopyright: 2005, Y\nLicense: Unknown-1\n",
+	"Copyright: 2006, Z\nLicense: MIT\nLicense: GPL-2+\n",
+	" stray continuation\n",
+	"junk\n",
+]
+
+ParagraphsParser = ControlParser.use(pselect=lambda _: ParagraphParser)
+
+
+def join(stanzas):
+	return "\n".join(stanzas)
+
+
+class ReparseTest(unittest.TestCase):
+
+	ROUNDS = 300
+
+	def parse(self, parser, text, prev=None):
+		"""Return the (state, diagnostics, warnings) of a parse of text,
+		incremental if prev is given."""
+		source = Source.from_string(text)
+		diag = []
+		stderr = sys.stderr
+		sys.stderr = captured = StringIO()
+		try:
+			if prev is None:
+				state = parser.parse(source.lines(), diag=diag, source=source)
+			else:
+				state = parser.reparse(prev, source.lines(), diag=diag, source=source)
+		finally:
+			sys.stderr = stderr
+		return state, diag, captured.getvalue()
+
+	def result(self, (state, diag, warnings)):
+		return (state.pretty(), "".join(state.iterblock(False)), str(state), state.keys,
+		  [(d.keystr, d.lineno, type(d.exc), str(d.exc)) for d in diag], warnings)
+
+	def edit(self, rand, stanzas):
+		stanzas = list(stanzas)
+		for _ in range(rand.randint(1, 3)):
+			op = rand.choice(["edit", "insert", "delete", "move"])
+			if op == "insert" or not stanzas:
+				stanzas.insert(rand.randint(0, len(stanzas)), rand.choice(STANZAS))
+			elif op == "edit":
+				i = rand.randrange(len(stanzas))
+				lines = stanzas[i].splitlines(True)
+				lines[rand.randrange(len(lines))] = rand.choice(rand.choice(STANZAS).splitlines(True))
+				stanzas[i] = "".join(lines)
+			elif op == "delete":
+				del stanzas[rand.randrange(len(stanzas))]
+			else:
+				stanza = stanzas.pop(rand.randrange(len(stanzas)))
+				stanzas.insert(rand.randint(0, len(stanzas)), stanza)
+		return stanzas
+
+	def check(self, parser, header=""):
+		rand = random.Random(23)
+		checked = 0
+		for _ in range(self.ROUNDS):
+			old = [rand.choice(STANZAS) for _ in range(rand.randint(0, 8))]
+			new = self.edit(rand, old)
+			try:
+				prev, _, _ = self.parse(parser, header + join(old))
+			except Exception:
+				continue  # not even recoverable
+			text = header + join(new)
+			self.assertEqual(self.result(self.parse(parser, text, prev)),
+			  self.result(self.parse(parser, text)), (old, new))
+			checked += 1
+		self.assertGreater(checked, self.ROUNDS // 2)
+
+	def test_copyright(self):
+		self.check(DebianCopyright, HEADER + "\n")
+
+	def test_copyright_malformed_header(self):
+		self.check(DebianCopyright)
+
+	def test_paragraphs(self):
+		self.check(ParagraphsParser)
+
+
+class KeyTableTest(unittest.TestCase):
+
+	def setUp(self):
+		self.interval = sys.getcheckinterval()
+		sys.setcheckinterval(1)  # switch threads as often as possible
+
+	def tearDown(self):
+		sys.setcheckinterval(self.interval)
+
+	def test_threads(self):
+		table = KeyTable()
+		keys = ["key%d" % i for i in range(20000)]
+		def intern(offset):  # every thread interns new keys at the same time
+			for i in range(offset, len(keys), 8):
+				table.id(keys[i])
+				table.id(keys[i - offset])
+		threads = [threading.Thread(target=intern, args=(i,)) for i in range(8)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertEqual(sorted(table.ids.values()), range(1, len(keys) + 1))
+		self.assertEqual(len(table.keys), len(keys) + 1)
+		for key in keys:
+			self.assertEqual(table.keys[table.id(key)], key)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for debian.source; run with PYTHONPATH=src python -m unittest discover tests
+
+@author: Ximin Luo <infinity0@gmx.com>
+"""
+
+from debian import source
+from debian.source import iter_source_paths
+from StringIO import StringIO
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+
+class TarPathsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def tarball(self, name, members):
+		fn = os.path.join(self.tmpdir, name)
+		with tarfile.open(fn, "w:gz") as tar:
+			for member in members:
+				info = tarfile.TarInfo(member)
+				info.size = 0
+				tar.addfile(info, StringIO())
+		return fn
+
+	def test_top_level_directory(self):
+		fn = self.tarball("pkg_1.0.orig.tar.gz", ["pkg-1.0/README", "pkg-1.0/src/a.c"])
+		self.assertEqual(list(iter_source_paths(fn)), ["README", "src/a.c"])
+
+	def test_component(self):
+		fn = self.tarball("pkg_1.0.orig-doc.tar.gz", ["doc-1.0/index.html"])
+		self.assertEqual(list(iter_source_paths(fn)), ["doc/index.html"])
+
+	def test_flat(self):
+		for members in (["README", "src/a.c"], ["src/a.c", "README"], ["./src/a.c", "./README"],
+		  ["src/a.c", "lib/b.c"]):
+			fn = self.tarball("pkg_1.0.orig.tar.gz", members)
+			self.assertEqual(list(iter_source_paths(fn)),
+			  [m[2:] if m.startswith("./") else m for m in members])
+
+	def test_debian_tarball(self):
+		fn = self.tarball("pkg_1.0-1.debian.tar.gz", ["debian/control", "debian/rules"])
+		self.assertEqual(list(iter_source_paths(fn)), ["debian/control", "debian/rules"])
+
+
+class LiveName(str):
+	"""Member name that counts how many of its kind are alive."""
+	live = peak = 0
+
+	def __new__(cls, name):
+		LiveName.live += 1
+		LiveName.peak = max(LiveName.peak, LiveName.live)
+		return str.__new__(cls, name)
+
+	def __del__(self):
+		LiveName.live -= 1
+
+
+class FakeMember(object):
+	def __init__(self, name):
+		self.name = LiveName(name)
+
+
+class BoundedMemoryTest(unittest.TestCase):
+
+	N = 100000
+
+	def setUp(self):
+		self.iter_tar_members = source.iter_tar_members
+		LiveName.live = LiveName.peak = 0
+
+	def tearDown(self):
+		source.iter_tar_members = self.iter_tar_members
+
+	def members(self, names):
+		source.iter_tar_members = lambda fn: (FakeMember(name) for name in names())
+
+	def check(self, names, expected):
+		self.members(names)
+		count = 0
+		for path in source.iter_tar_paths("pkg_1.0.orig.tar.gz"):
+			if count < 3:
+				self.assertEqual(path, expected[count])
+			count += 1
+		self.assertEqual(count, self.N)
+		self.assertLessEqual(LiveName.peak, 4)
+
+	def test_top_level_directory(self):
+		self.check(lambda: ("pkg-1.0/src/f%d.c" % i for i in xrange(self.N)),
+		  ["src/f0.c", "src/f1.c", "src/f2.c"])
+
+	def test_flat(self):
+		self.check(lambda: ("src/f%d.c" % i if i != self.N - 1 else "README"
+		  for i in xrange(self.N)), ["src/f0.c", "src/f1.c", "src/f2.c"])
+
+
+if __name__ == "__main__":
+	unittest.main()